@@ -0,0 +1,206 @@
+"""Benchmarks for the penrose placement engine and the robinson deflation
+engine.  Every benchmark uses fixed seeds and sizes so that runs on different
+commits can be compared; results are written as JSON."""
+
+import os
+import imp
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+from timeit import default_timer as timer
+
+import penrose
+
+penrose_robinson = imp.load_source('penrose_robinson', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'penrose-robinson.py'))
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def random_points(n, seed=1):
+    rng = random.Random(seed)
+    return [Point(rng.uniform(0.0, 100.0), rng.uniform(0.0, 100.0)) for i in range(n)]
+
+
+def bench_quadtree_insert(n):
+    points = random_points(n)
+    start_time = timer()
+    qt = penrose.QuadTree(0.0, 0.0, 100.0, 100.0)
+    for p in points:
+        qt.add(p)
+    return timer() - start_time, n
+
+
+def bench_quadtree_bulk_load(n):
+    points = random_points(n)
+    start_time = timer()
+    penrose.QuadTree.bulk_load(points, 0.0, 0.0, 100.0, 100.0)
+    return timer() - start_time, n
+
+
+def bench_quadtree_find(n, num_queries=1000):
+    qt = penrose.QuadTree.bulk_load(random_points(n), 0.0, 0.0, 100.0, 100.0)
+    rng = random.Random(2)
+    queries = []
+    for i in range(num_queries):
+        x = rng.uniform(0.0, 98.0)
+        y = rng.uniform(0.0, 98.0)
+        queries.append((x, y, x + 2.0, y + 2.0))
+    start_time = timer()
+    for q in queries:
+        qt.find(*q)
+    return timer() - start_time, num_queries
+
+
+def bench_place_piece(n, **options):
+    """Plan every shape on every open anchor of a board of n pieces."""
+    board = penrose.grow_board(1, n, **options)
+    # Use the board's own shapes, which have matching edge types
+    shapes = sorted(set(p.shape for p in board.pieces), key=lambda s: s.name)
+    anchors = [x[-1] for x in board.frontier.queue if x[-1].piece is None]
+    start_time = timer()
+    count = 0
+    for anchor in anchors:
+        for shape in shapes:
+            try:
+                board.plan_piece(penrose.Piece(shape), anchor)
+            except penrose.TileError:
+                pass
+            count += 1
+    return timer() - start_time, count
+
+
+def bench_add_random_piece(n, **options):
+    start_time = timer()
+    penrose.grow_board(1, n, **options)
+    return timer() - start_time, n
+
+
+def bench_penrose_svg(n):
+    board = penrose.grow_board(1, n)
+    start_time = timer()
+    penrose.board_to_svg(board)
+    return timer() - start_time, len(board.pieces)
+
+
+def make_robinson_board():
+    random.seed(1)
+    board = penrose_robinson.Board(-410.0, -410.0, 410.0, 410.0)
+    tiling = penrose_robinson.P2Tiling()
+    tiling.create_circle(board, 0.0, 0.0, -90.0, 400.0)
+    return board
+
+
+def bench_robinson_deflate(generation):
+    """Time the deflation that produces the given generation."""
+    board = make_robinson_board()
+    for i in range(generation - 1):
+        board.deflate()
+    start_time = timer()
+    board.deflate()
+    return timer() - start_time, len(board.triangles)
+
+
+def bench_robinson_batch_deflate(generation):
+    """Time the batch deflation that produces the given generation."""
+    board = make_robinson_board()
+    g = board.get_batch_generation(generation - 1)
+    start_time = timer()
+    g = g.deflate(board.x1, board.y1, board.x2, board.y2)
+    return timer() - start_time, len(g)
+
+
+def bench_robinson_svg(generation):
+    board = make_robinson_board()
+    for i in range(generation):
+        board.deflate()
+    start_time = timer()
+    board.render_to_svg()
+    return timer() - start_time, len(board.triangles)
+
+
+def get_benchmarks(quick=False):
+    if quick:
+        quadtree_sizes = [10**3, 10**4]
+        piece_counts = [100, 1000]
+        generations = [1, 2, 3, 4]
+    else:
+        quadtree_sizes = [10**3, 10**4, 10**5, 10**6]
+        piece_counts = [100, 1000, 5000]
+        generations = [1, 2, 3, 4, 5, 6]
+
+    benchmarks = []
+    for n in quadtree_sizes:
+        benchmarks.append(('quadtree_insert', {'n': n}, bench_quadtree_insert, (n,), {}))
+        benchmarks.append(('quadtree_bulk_load', {'n': n}, bench_quadtree_bulk_load, (n,), {}))
+        benchmarks.append(('quadtree_find', {'n': n}, bench_quadtree_find, (n,), {}))
+    for n in piece_counts:
+        for mode in ['default', 'exact']:
+            options = {}
+            if mode == 'exact':
+                options = {'exact': True, 'snap': True}
+            benchmarks.append(('place_piece', {'n': n, 'mode': mode}, bench_place_piece, (n,), options))
+            benchmarks.append(('add_random_piece', {'n': n, 'mode': mode}, bench_add_random_piece, (n,), options))
+        benchmarks.append(('penrose_svg', {'n': n}, bench_penrose_svg, (n,), {}))
+    for g in generations:
+        benchmarks.append(('robinson_deflate', {'generation': g}, bench_robinson_deflate, (g,), {}))
+        benchmarks.append(('robinson_batch_deflate', {'generation': g}, bench_robinson_batch_deflate, (g,), {}))
+        benchmarks.append(('robinson_svg', {'generation': g}, bench_robinson_svg, (g,), {}))
+    return benchmarks
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(benchmarks, repeat=3, name_filter=None):
+    results = []
+    for name, params, f, args, options in benchmarks:
+        if name_filter is not None and name_filter not in name:
+            continue
+        # Take the best of several runs, as the least disturbed by other load
+        timings = [f(*args, **options) for i in range(repeat)]
+        seconds, ops = min(timings)
+        result = {
+            'name': name,
+            'params': params,
+            'seconds': seconds,
+            'ops': ops,
+            'ops_per_second': ops / seconds if seconds > 0 else None,
+        }
+        print >>sys.stderr, '%-20s %-40s %10.4fs %12.1f ops/s' % (name, json.dumps(params, sort_keys=True), seconds, result['ops_per_second'] or 0.0)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the penrose benchmarks')
+    parser.add_argument('--output', default='benchmark.json', help='file to write JSON results to')
+    parser.add_argument('--quick', action='store_true', help='only run the smaller sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best is reported')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    results = run(get_benchmarks(args.quick), args.repeat, args.filter)
+
+    f = open(args.output, 'wt')
+    json.dump({
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'quick': args.quick,
+        'results': results,
+    }, f, indent=2, sort_keys=True)
+    f.close()
+
+
+if __name__ == '__main__':
+    main()
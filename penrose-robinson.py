@@ -1,6 +1,42 @@
+import os
 import sys
 import math
 import random
+import shutil
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from penrose import segment_meets_rect
+
+def point_in_polygon(x, y, points):
+    inside = False
+    px1, py1 = points[-1]
+    for px2, py2 in points:
+        if (py1 > y) != (py2 > y) and x < px1 + (y - py1) * (px2 - px1) / (py2 - py1):
+            inside = not inside
+        px1, py1 = px2, py2
+    return inside
+
+
+def reachable_archetypes(archetypes):
+    """Return the archetypes with every archetype they deflate into, in the
+    order they are found."""
+    result = []
+    seen = set()
+    pending = list(archetypes)
+    while pending:
+        archetype = pending.pop(0)
+        if archetype in seen:
+            continue
+        seen.add(archetype)
+        result.append(archetype)
+        pending.extend(shape for shape, pt, angle, scale, loneliness_rule in archetype.subshapes)
+    return result
+
 
 class Archetype(object):
     def __init__(self, name, happy_sides, *segments):
@@ -11,6 +47,7 @@ class Archetype(object):
         self.happy_sides = happy_sides
         self.internal_neighbour_rules = []
         self.external_neighbour_rules = {}
+        self.symbol = None
         
         self.points = []
         self.polar_points = []
@@ -27,6 +64,9 @@ class Archetype(object):
             angle += delta
             if angle >= 360.0:
                 angle -= 360.0
+        
+        # Radius of a circle around point 0 containing the whole shape
+        self.radius = max(m for a, m in self.polar_points)
     
     def reflect_segments(self):
         result = []
@@ -51,6 +91,13 @@ class Archetype(object):
         
         return ''.join(parts)
     
+    def get_symbol(self):
+        """Return the archetype as an element for the SVG <defs>, rendered the
+        first time.  Its fill is inherited, so each <use> sets its colour."""
+        if self.symbol is None:
+            self.symbol = '<g id="%s">%s</g>' % (self.name, self.render_to_svg({'colour': 'inherit'}))
+        return self.symbol
+    
     def add_decor(self, path_str, args, style_str):
         self.decors.append((path_str, args, style_str))
     
@@ -68,15 +115,11 @@ class Archetype(object):
         
         for match in matches:
             self.external_neighbour_rules[(side, match)] = rules
-    
-    def __hash__(self):
-        return id(self)
-    
-    def __eq__(self, other):
-        return self == other
 
 
 class Triangle(object):
+    __slots__ = ('archetype', 'x', 'y', 'angle', 'scale', 'neighbours', 'subtriangles', 'colour')
+    
     def __init__(self, archetype, x, y, angle, scale):
         self.archetype = archetype
         self.x = x
@@ -104,14 +147,37 @@ class Triangle(object):
         
         return sx/len(points), sy/len(points)
     
+    def may_overlap(self, x1, y1, x2, y2):
+        """Conservative test for whether the triangle, and hence anything it
+        deflates into, might overlap the rectangle."""
+        r = self.scale * self.archetype.radius
+        dx = max(x1 - self.x, 0.0, self.x - x2)
+        dy = max(y1 - self.y, 0.0, self.y - y2)
+        return dx * dx + dy * dy <= r * r
+    
     def within(self, x1, y1, x2, y2):
-        #for px,py in self.get_points():
-        #    if px < x1 or py < y1 or px > x2 or py > x2:
-        #        return False
-        #return True
-        for px,py in self.get_points():
-            if px >= x1 and py >= y1 and px <= x2 and py <= x2:
+        """Whether any part of the triangle overlaps the rectangle.  Most
+        triangles are decided by their bounding circle alone; the outline is
+        only computed for those straddling an edge of the rectangle."""
+        r = self.scale * self.archetype.radius
+        if self.x - r >= x1 and self.y - r >= y1 and self.x + r <= x2 and self.y + r <= y2:
+            return True
+        if not self.may_overlap(x1, y1, x2, y2):
+            return False
+        
+        points = self.get_points()
+        for px,py in points:
+            if px >= x1 and py >= y1 and px <= x2 and py <= y2:
+                return True
+        # No vertex inside, so either the rectangle is inside the outline or
+        # an edge of the outline crosses it
+        if point_in_polygon(x1, y1, points):
+            return True
+        px1, py1 = points[-1]
+        for px2, py2 in points:
+            if segment_meets_rect(px1, py1, px2, py2, x1, y1, x2, y2):
                 return True
+            px1, py1 = px2, py2
         return False
     
     def is_lonely(self):
@@ -123,13 +189,20 @@ class Triangle(object):
     def add_neighbour(self, side, neighbour, neighbour_side):
         self.neighbours[side] = (neighbour, neighbour_side)
     
-    def deflate(self):
+    def get_subtriangles(self):
+        """Create the triangles this one deflates into, without recording them."""
+        subtriangles = []
         for shape, pt, angle, scale, loneliness_rule in self.archetype.subshapes:
             a, m = self.archetype.polar_points[pt]
             x = self.x + self.scale * m * math.cos(math.radians(self.angle + a))
             y = self.y + self.scale * m * math.sin(math.radians(self.angle + a))
             t = shape.generate(x, y, self.angle + angle, self.scale * scale)
-            self.subtriangles.append(t)
+            subtriangles.append(t)
+        
+        return subtriangles
+    
+    def deflate(self):
+        self.subtriangles.extend(self.get_subtriangles())
         
         return self.subtriangles
     
@@ -143,6 +216,9 @@ class Triangle(object):
             if n is None:
                 continue
             neighbour, neighbour_side = n
+            # A neighbour outside the board was never deflated
+            if not neighbour.subtriangles:
+                neighbour.deflate()
             
             if (side, neighbour.archetype) not in self.archetype.external_neighbour_rules:
                 print >> sys.stderr, 'No matching rules for %s side %d meets %s' % (self.archetype.name, side, neighbour.archetype.name)
@@ -156,11 +232,17 @@ class Triangle(object):
                 
                 self.subtriangles[from_shape].add_neighbour(from_side, neighbour.subtriangles[to_shape], to_side)
     
-    def render_to_svg(self):
+    def render_to_svg(self, fade_lonely=True, use_symbol=False):
+        """Render the triangle, either in full or, if use_symbol is set, as a
+        <use> of its archetype's symbol, which must be in the <defs>."""
+        faded = fade_lonely and self.is_lonely()
+        if use_symbol:
+            return render_use(self.archetype.name, self.x, self.y, self.angle, self.scale, self.colour, faded)
+        
         args = {}
         args['colour'] = '#%02x%02x%02x' % self.colour
         
-        if self.is_lonely():
+        if faded:
             extra = """opacity="0.25" """
         else:
             extra = ""
@@ -194,6 +276,57 @@ class Triangle(object):
         return 'Triangle<%x>' % id(self)
 
 
+def render_use(name, x, y, angle, scale, colour, faded):
+    """Render a <use> of the named archetype's symbol."""
+    if faded:
+        extra = """opacity="0.25" """
+    else:
+        extra = ""
+    return """<use xlink:href="#%s" transform="translate(%f, %f) rotate(%f) scale(%f)" fill="#%02x%02x%02x" %s/>""" % ((name, x, y, angle, scale) + tuple(colour) + (extra,))
+
+
+def render_tile(args):
+    """Write the <use> elements for one tile of triangles to a fragment file.
+    Runs in a worker process, so the triangles are given as tuples of the
+    arguments to render_use."""
+    path, items = args
+    f = open(path, 'wt')
+    for item in items:
+        f.write(render_use(*item))
+        f.write('\n')
+    f.close()
+
+
+class FrameWriter(object):
+    """Render a board's current triangles to an SVG file on a process pool.
+    The triangles are split into tiles, each of which a worker writes to its
+    own fragment file; finish then concatenates the fragments between the
+    header and footer.  The board can be changed as soon as the FrameWriter
+    is created, so several frames can be in progress at once."""
+    
+    def __init__(self, board, pool, path, tiles=4):
+        self.path = path
+        self.header = board.get_svg_header()
+        self.footer = board.get_svg_footer()
+        
+        tile_items = board.get_tiles(tiles)
+        self.fragment_paths = ['%s.%d.part' % (path, i) for i in range(len(tile_items))]
+        self.result = pool.map_async(render_tile, zip(self.fragment_paths, tile_items))
+    
+    def finish(self):
+        self.result.get()
+        
+        f = open(self.path, 'wt')
+        f.write(self.header)
+        for fragment_path in self.fragment_paths:
+            fragment = open(fragment_path, 'rt')
+            shutil.copyfileobj(fragment, f)
+            fragment.close()
+            os.remove(fragment_path)
+        f.write(self.footer)
+        f.close()
+
+
 def random_colour():
     x = random.randrange(-100, 100)
     if x < 0:
@@ -202,15 +335,262 @@ def random_colour():
         return (255, x, x)
 
 
+# Neighbour indexes in a Generation that are not triangles in it
+NO_NEIGHBOUR = -1
+OUTSIDE = -2
+
+
+def expand_rows(starts, counts):
+    """For items that each have counts[i] rows beginning at starts[i], return
+    the item and row number of every row, in order."""
+    items = numpy.repeat(numpy.arange(len(counts)), counts)
+    firsts = numpy.cumsum(counts) - counts
+    rows = numpy.repeat(starts - firsts, counts) + numpy.arange(counts.sum())
+    return items, rows
+
+
+class ArchetypeTables(object):
+    """Numbers each archetype, and any it deflates into, and flattens their
+    subshapes and neighbour rules into arrays so a Generation can deflate with
+    numpy.  The subshapes of archetype i are the rows starts[i] to
+    starts[i]+counts[i], and likewise for its internal rules.  External
+    rules are found by archetype, side and neighbour archetype, with a count
+    of -1 where there is no rule."""
+    
+    def __init__(self, archetypes):
+        if numpy is None:
+            raise ImportError('numpy is required for batch deflation')
+        
+        self.archetypes = reachable_archetypes(archetypes)
+        self.ids = dict((a, i) for i, a in enumerate(self.archetypes))
+        
+        starts = []
+        counts = []
+        rows = []
+        for archetype in self.archetypes:
+            starts.append(len(rows))
+            counts.append(len(archetype.subshapes))
+            for shape, pt, angle, scale, loneliness_rule in archetype.subshapes:
+                a, m = archetype.polar_points[pt]
+                rows.append((self.ids[shape], a, m, angle, scale))
+        
+        self.radius = numpy.array([a.radius for a in self.archetypes])
+        self.starts = numpy.array(starts, dtype=numpy.intp)
+        self.counts = numpy.array(counts, dtype=numpy.intp)
+        self.child_ids = numpy.array([r[0] for r in rows], dtype=numpy.intp)
+        self.child_a = numpy.array([r[1] for r in rows], dtype=float)
+        self.child_m = numpy.array([r[2] for r in rows], dtype=float)
+        self.child_angle = numpy.array([r[3] for r in rows], dtype=float)
+        self.child_scale = numpy.array([r[4] for r in rows], dtype=float)
+        
+        n = len(self.archetypes)
+        self.num_sides = max([len(a.happy_sides) for a in self.archetypes] or [0])
+        # Missing sides count as happy, so they never make a triangle lonely
+        self.happy = numpy.ones((n, self.num_sides), dtype=bool)
+        for i, archetype in enumerate(self.archetypes):
+            self.happy[i, :len(archetype.happy_sides)] = archetype.happy_sides
+        
+        internal = []
+        internal_starts = []
+        internal_counts = []
+        for archetype in self.archetypes:
+            internal_starts.append(len(internal))
+            internal_counts.append(len(archetype.internal_neighbour_rules))
+            internal.extend(archetype.internal_neighbour_rules)
+        self.internal_starts = numpy.array(internal_starts, dtype=numpy.intp)
+        self.internal_counts = numpy.array(internal_counts, dtype=numpy.intp)
+        self.internal_rules = numpy.array(internal, dtype=numpy.intp).reshape(-1, 4)
+        
+        external = []
+        self.external_starts = numpy.zeros((n, self.num_sides, n), dtype=numpy.intp)
+        self.external_counts = numpy.empty((n, self.num_sides, n), dtype=numpy.intp)
+        self.external_counts.fill(-1)
+        for i, archetype in enumerate(self.archetypes):
+            for (side, match), rules in archetype.external_neighbour_rules.items():
+                if match not in self.ids:
+                    continue
+                j = self.ids[match]
+                self.external_starts[i, side, j] = len(external)
+                self.external_counts[i, side, j] = len(rules)
+                for (from_shape, from_side), (to_shape, to_side) in sorted(rules.items()):
+                    external.append((from_shape, from_side, to_shape, to_side))
+        self.external_rules = numpy.array(external, dtype=numpy.intp).reshape(-1, 4)
+
+
+class Generation(object):
+    """A generation of triangles held as parallel arrays of archetype id,
+    position, angle and scale.  Deflating computes every child at once from
+    the ArchetypeTables, without creating a Triangle for each one.
+    
+    Neighbours are held as arrays with a column per side: the index of the
+    neighbour, or NO_NEIGHBOUR, or OUTSIDE for one beyond the board; the
+    side of the neighbour that meets it; and the neighbour's archetype id,
+    or -1 if there is none."""
+    
+    def __init__(self, tables, ids, x, y, angle, scale, neighbours=None, neighbour_sides=None, neighbour_archetypes=None):
+        self.tables = tables
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self.angle = angle
+        self.scale = scale
+        
+        shape = (len(ids), tables.num_sides)
+        if neighbours is None:
+            neighbours = numpy.empty(shape, dtype=numpy.intp)
+            neighbours.fill(NO_NEIGHBOUR)
+            neighbour_sides = numpy.zeros(shape, dtype=numpy.intp)
+            neighbour_archetypes = numpy.empty(shape, dtype=numpy.intp)
+            neighbour_archetypes.fill(-1)
+        self.neighbours = neighbours
+        self.neighbour_sides = neighbour_sides
+        self.neighbour_archetypes = neighbour_archetypes
+    
+    @classmethod
+    def from_triangles(cls, tables, triangles):
+        """Build a generation from Triangles, keeping their neighbours; those
+        not among the triangles are taken to be outside the board."""
+        triangles = list(triangles)
+        g = cls(tables,
+                numpy.array([tables.ids[t.archetype] for t in triangles], dtype=numpy.intp),
+                numpy.array([t.x for t in triangles], dtype=float),
+                numpy.array([t.y for t in triangles], dtype=float),
+                numpy.array([t.angle for t in triangles], dtype=float),
+                numpy.array([t.scale for t in triangles], dtype=float))
+        
+        indexes = dict((t, i) for i, t in enumerate(triangles))
+        for i, t in enumerate(triangles):
+            for side, n in enumerate(t.neighbours):
+                if n is None:
+                    continue
+                neighbour, neighbour_side = n
+                g.neighbours[i, side] = indexes.get(neighbour, OUTSIDE)
+                g.neighbour_sides[i, side] = neighbour_side
+                g.neighbour_archetypes[i, side] = tables.ids[neighbour.archetype]
+        return g
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def select(self, mask):
+        """Return the triangles picked by mask; neighbours that are dropped
+        become OUTSIDE."""
+        kept = numpy.nonzero(mask)[0]
+        neighbours = self.neighbours[kept]
+        if len(self):
+            remap = numpy.empty(len(self), dtype=numpy.intp)
+            remap.fill(OUTSIDE)
+            remap[kept] = numpy.arange(len(kept))
+            neighbours = numpy.where(neighbours >= 0, remap[numpy.maximum(neighbours, 0)], neighbours)
+        return Generation(self.tables, self.ids[kept], self.x[kept], self.y[kept], self.angle[kept], self.scale[kept],
+                neighbours, self.neighbour_sides[kept], self.neighbour_archetypes[kept])
+    
+    def lonely(self):
+        """Return a mask of the triangles missing a neighbour on an unhappy
+        side."""
+        return ((self.neighbour_archetypes < 0) & ~self.tables.happy[self.ids]).any(axis=1)
+    
+    def get_colour_owners(self):
+        """Return for each triangle the index of the one whose colour it ends
+        up with, if each triangle in turn is given a colour that it also sets
+        on its neighbours across unhappy sides, as Triangle.set_colour does."""
+        owners = numpy.arange(len(self.ids))
+        unhappy = (self.neighbours >= 0) & ~self.tables.happy[self.ids]
+        i, side = numpy.nonzero(unhappy)
+        # The last triangle to set a colour on each one wins
+        numpy.maximum.at(owners, self.neighbours[i, side], i)
+        return owners
+    
+    def get_triangle(self, i):
+        return Triangle(self.tables.archetypes[self.ids[i]], float(self.x[i]), float(self.y[i]), float(self.angle[i]), float(self.scale[i]))
+    
+    def iter_triangles(self):
+        archetypes = self.tables.archetypes
+        for i, x, y, angle, scale in zip(self.ids.tolist(), self.x.tolist(), self.y.tolist(), self.angle.tolist(), self.scale.tolist()):
+            yield Triangle(archetypes[i], x, y, angle, scale)
+    
+    def clip(self, x1, y1, x2, y2):
+        """Keep the triangles overlapping the rectangle.  As with
+        Triangle.within, only those whose bounding circle straddles an edge of
+        the rectangle need their outline tested."""
+        r = self.scale * self.tables.radius[self.ids]
+        dx = numpy.maximum(numpy.maximum(x1 - self.x, self.x - x2), 0.0)
+        dy = numpy.maximum(numpy.maximum(y1 - self.y, self.y - y2), 0.0)
+        keep = dx * dx + dy * dy <= r * r
+        inside = (self.x - r >= x1) & (self.y - r >= y1) & (self.x + r <= x2) & (self.y + r <= y2)
+        for i in numpy.nonzero(keep & ~inside)[0]:
+            keep[i] = self.get_triangle(i).within(x1, y1, x2, y2)
+        return self.select(keep)
+    
+    def deflate(self, x1, y1, x2, y2):
+        """Return the next generation, clipped to the rectangle.  Children are
+        ordered by parent, then by subshape."""
+        tables = self.tables
+        counts = tables.counts[self.ids]
+        firsts = numpy.cumsum(counts) - counts
+        parents, rows = expand_rows(tables.starts[self.ids], counts)
+        
+        parent_angle = self.angle[parents]
+        parent_scale = self.scale[parents]
+        radians = numpy.radians(parent_angle + tables.child_a[rows])
+        m = parent_scale * tables.child_m[rows]
+        x = self.x[parents] + m * numpy.cos(radians)
+        y = self.y[parents] + m * numpy.sin(radians)
+        
+        child = Generation(tables, tables.child_ids[rows], x, y, parent_angle + tables.child_angle[rows], parent_scale * tables.child_scale[rows])
+        self.find_neighbours(child, firsts)
+        return child.clip(x1, y1, x2, y2)
+    
+    def find_neighbours(self, child, firsts):
+        """Link the children, where the children of triangle i begin at
+        firsts[i], by applying the internal rules of each triangle and the
+        external rules for each pair of neighbours."""
+        tables = self.tables
+        
+        items, rows = expand_rows(tables.internal_starts[self.ids], tables.internal_counts[self.ids])
+        rules = tables.internal_rules[rows]
+        a = firsts[items] + rules[:, 0]
+        b = firsts[items] + rules[:, 2]
+        child.link(a, rules[:, 1], b, rules[:, 3], child.ids[b])
+        child.link(b, rules[:, 3], a, rules[:, 1], child.ids[a])
+        
+        triangles, sides = numpy.nonzero(self.neighbour_archetypes >= 0)
+        archetypes = self.ids[triangles]
+        neighbour_archetypes = self.neighbour_archetypes[triangles, sides]
+        counts = tables.external_counts[archetypes, sides, neighbour_archetypes]
+        for i in numpy.nonzero(counts < 0)[0]:
+            print >> sys.stderr, 'No matching rules for %s side %d meets %s' % (tables.archetypes[archetypes[i]].name, sides[i], tables.archetypes[neighbour_archetypes[i]].name)
+        counts = numpy.maximum(counts, 0)
+        
+        items, rows = expand_rows(tables.external_starts[archetypes, sides, neighbour_archetypes], counts)
+        rules = tables.external_rules[rows]
+        triangles = triangles[items]
+        neighbours = self.neighbours[triangles, sides[items]]
+        neighbour_archetypes = neighbour_archetypes[items]
+        a = firsts[triangles] + rules[:, 0]
+        b = numpy.where(neighbours >= 0, firsts[numpy.maximum(neighbours, 0)] + rules[:, 2], OUTSIDE)
+        child.link(a, rules[:, 1], b, rules[:, 3], tables.child_ids[tables.starts[neighbour_archetypes] + rules[:, 2]])
+    
+    def link(self, triangles, sides, neighbours, neighbour_sides, neighbour_archetypes):
+        self.neighbours[triangles, sides] = neighbours
+        self.neighbour_sides[triangles, sides] = neighbour_sides
+        self.neighbour_archetypes[triangles, sides] = neighbour_archetypes
+
+
 class Board(object):
-    def __init__(self, x1, y1, x2, y2):
+    def __init__(self, x1, y1, x2, y2, keep_generations=None):
         self.x1 = x1
         self.y1 = y1
         self.x2 = x2
         self.y2 = y2
         
         self.triangles = set()
-        self.old_triangles = set()
+        # Each old generation is kept as [triangles, (scale, dx, dy)], where the
+        # transform places it off to the side; only the most recent
+        # keep_generations are kept, or all of them if that is None.
+        self.keep_generations = keep_generations
+        self.old_generations = []
+        self.tables = None
     
     def add(self, triangle):
         if not triangle.within(self.x1, self.y1, self.x2, self.y2):
@@ -220,43 +600,150 @@ class Board(object):
         #print triangle, triangle.neighbours
     
     def deflate(self):
+        """Replace the triangles with those they deflate into, linked to their
+        neighbours.  This stays one Triangle at a time: building the linked
+        Triangles from a Generation costs as much as deflating them here, so
+        only get_batch_generation and write_generation_svg, which never make
+        them, gain from the tables."""
         #print 'Deflating %d triangles' % len(self.triangles)
         
         new_triangles = []
         
         for t in self.triangles:
             new_triangles.extend(t.deflate())
-            self.old_triangles.add(t)
         
         for t in self.triangles:
             t.find_neighbours()
         
+        # Neighbours are only ever resolved between a generation and the next,
+        # so older generations are only needed for rendering
+        self.old_generations.append([self.triangles, (1.0, 0.0, 0.0)])
+        if self.keep_generations is not None and len(self.old_generations) > self.keep_generations:
+            del self.old_generations[:len(self.old_generations) - self.keep_generations]
+        
         self.triangles = set()
         for t in new_triangles:
             self.add(t)
             t.set_colour(random_colour())
         
-        for t in self.old_triangles:
-            t.x -= 75.0
-            t.scale *= 0.75
-            t.x *= 0.75
-            t.y *= 0.75
+        # Shrink the old generations and move them left, one transform each
+        for generation in self.old_generations:
+            scale, dx, dy = generation[1]
+            generation[1] = (scale * 0.75, (dx - 75.0) * 0.75, dy * 0.75)
     
-    def render_to_svg(self):
+    def get_archetypes(self):
+        """Return every archetype that the board's triangles, old and current,
+        are or could deflate into."""
+        archetypes = set(t.archetype for t in self.triangles)
+        for triangles, transform in self.old_generations:
+            archetypes.update(t.archetype for t in triangles)
+        return reachable_archetypes(sorted(archetypes, key=lambda a: a.name))
+    
+    def get_tiles(self, tiles):
+        """Split the triangles into a grid of tiles by position, returning for
+        each tile, in rows, a list of the arguments to render_use."""
+        width = (self.x2 - self.x1) / tiles
+        height = (self.y2 - self.y1) / tiles
+        result = [[] for i in range(tiles * tiles)]
+        for t in self.triangles:
+            i = min(max(int((t.x - self.x1) / width), 0), tiles - 1)
+            j = min(max(int((t.y - self.y1) / height), 0), tiles - 1)
+            result[j * tiles + i].append((t.archetype.name, t.x, t.y, t.angle, t.scale, t.colour, t.is_lonely()))
+        return result
+    
+    def render_to_svg(self, show_old=False):
         parts = []
         for t in self.triangles:
-            parts.append(t.render_to_svg())
-        #for t in board.old_triangles:
-        #    parts.append(t.render_to_svg())
+            parts.append(t.render_to_svg(use_symbol=True))
+        if show_old:
+            for triangles, (scale, dx, dy) in self.old_generations:
+                parts.append("""<g transform="translate(%f, %f) scale(%f)">""" % (dx, dy, scale))
+                for t in triangles:
+                    parts.append(t.render_to_svg(use_symbol=True))
+                parts.append("""</g>""")
         content = '\n'.join(parts)
-        svg = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg width="100%%" height="100%%" viewBox="0 0 %f %f" xmlns="http://www.w3.org/2000/svg"> 
-<g transform="translate(%f, %f)">
+        return self.get_svg_header() + content + self.get_svg_footer()
+    
+    def get_svg_header(self):
+        """Return the start of the SVG, with a symbol in the <defs> for each of
+        the board's archetypes."""
+        defs = '\n'.join(a.get_symbol() for a in self.get_archetypes())
+        return """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg width="100%%" height="100%%" viewBox="0 0 %f %f" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"> 
+<defs>
 %s
+</defs>
+<g transform="translate(%f, %f)">
+""" % (self.x2 - self.x1, self.y2 - self.y1, defs, -self.x1, -self.y1)
+    
+    def get_svg_footer(self):
+        return """
 </g>
 </svg>
-""" % (self.x2 - self.x1, self.y2 - self.y1, -self.x1, -self.y1, content)
-        return svg
+"""
+    
+    def iter_generation(self, generation):
+        """Yield the triangles that the current ones would become after the
+        given number of deflations.  The hierarchy is expanded depth first and
+        any triangle that misses the board is skipped before it is expanded,
+        so only the stack of pending triangles is held in memory.  The
+        triangles are not added to the board and have no neighbours."""
+        stack = [(t, 0) for t in self.triangles]
+        while stack:
+            t, depth = stack.pop()
+            if not t.within(self.x1, self.y1, self.x2, self.y2):
+                continue
+            
+            if depth == generation:
+                yield t
+                continue
+            
+            subtriangles = t.get_subtriangles()
+            subtriangles.reverse()
+            for s in subtriangles:
+                stack.append((s, depth + 1))
+    
+    def get_tables(self):
+        """Return ArchetypeTables covering the board's archetypes, compiling
+        them again only when the board has one they do not cover."""
+        archetypes = set(t.archetype for t in self.triangles)
+        if self.tables is None or not archetypes.issubset(self.tables.ids):
+            self.tables = ArchetypeTables(sorted(archetypes, key=lambda a: a.name))
+        return self.tables
+    
+    def get_batch_generation(self, generation, tables=None):
+        """Compute the given generation below the current one as a
+        Generation, deflating all triangles at once.  Like iter_generation,
+        the board is not changed.  The board's tables are used if none are
+        given."""
+        if tables is None:
+            tables = self.get_tables()
+        g = Generation.from_triangles(tables, self.triangles)
+        for i in range(generation):
+            g = g.deflate(self.x1, self.y1, self.x2, self.y2)
+        return g
+    
+    def write_generation_svg(self, f, generation, batch=False, tables=None):
+        """Render the given generation below the current one straight to a
+        file, using iter_generation, or get_batch_generation if batch is set.
+        In a batch, colours are shared and lonely triangles faded as deflate
+        and render_to_svg do.  Otherwise neighbours are not known, so each
+        triangle gets its own random colour."""
+        f.write(self.get_svg_header())
+        if batch:
+            g = self.get_batch_generation(generation, tables)
+            names = [a.name for a in g.tables.archetypes]
+            colours = [random_colour() for i in range(len(g))]
+            colours = [colours[i] for i in g.get_colour_owners().tolist()]
+            for a, x, y, angle, scale, colour, lonely in zip(g.ids.tolist(), g.x.tolist(), g.y.tolist(), g.angle.tolist(), g.scale.tolist(), colours, g.lonely().tolist()):
+                f.write(render_use(names[a], x, y, angle, scale, colour, lonely))
+                f.write('\n')
+        else:
+            for t in self.iter_generation(generation):
+                t.colour = random_colour()
+                f.write(t.render_to_svg(fade_lonely=False, use_symbol=True))
+                f.write('\n')
+        f.write(self.get_svg_footer())
 
 
 class P2Tiling(object):
@@ -343,9 +830,20 @@ class P2Tiling(object):
         self.shape1b = shape1b
         self.shape2a = shape2a
         self.shape2b = shape2b
+        self.archetypes = [shape1a, shape1b, shape2a, shape2b]
+        self.tables = None
+    
+    def get_tables(self):
+        """Return the ArchetypeTables for this tiling, compiling them the first
+        time."""
+        if self.tables is None:
+            self.tables = ArchetypeTables(self.archetypes)
+        return self.tables
 
 
     def create_circle(self, board, cx, cy, angle, scale):
+        if board.tables is None:
+            board.tables = self.get_tables()
         triangles = []
         
         for i in range(5):
@@ -374,7 +872,7 @@ class P2Tiling(object):
 
 
 def main():
-    board = Board(-410.0, -410.0, 410.0, 410.0)
+    board = Board(-410.0, -410.0, 410.0, 410.0, keep_generations=0)
     
     tiling = P2Tiling()
     
@@ -395,11 +893,16 @@ def main():
         #t2 = shape2b.generate(x, y, a + 216.0, scale)
         #board.add(t2)
     
+    # Frames are rendered in the background while the next ones are deflated
+    pool = multiprocessing.Pool()
+    frames = []
     for i in range(5):
-        f = open('penrose-robinson-%02d.svg' % i, 'wt')
-        f.write(board.render_to_svg())
-        f.close()
+        frames.append(FrameWriter(board, pool, 'penrose-robinson-%02d.svg' % i))
         board.deflate()
+    for frame in frames:
+        frame.finish()
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,32 @@
+import os
+import copy
 import math
 import random
 import time
+import json
+import argparse
+import multiprocessing
 import heapq
+import collections
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# In exact-angle mode every angle is a whole number of steps of this size
+STEP_ANGLE = 36.0
+NUM_STEPS = 10
+STEP_DIRECTIONS = [(math.cos(math.radians(k * STEP_ANGLE)), math.sin(math.radians(k * STEP_ANGLE))) for k in range(NUM_STEPS)]
+
+
+def angle_to_step(angle):
+    step = int(round(angle / STEP_ANGLE))
+    if abs(angle - step * STEP_ANGLE) > 1e-6:
+        raise ValueError('Angle %f is not a multiple of %f' % (angle, STEP_ANGLE))
+    return step % NUM_STEPS
 
 
 def line_intersection(p0_x, p0_y, p1_x, p1_y, p2_x, p2_y, p3_x, p3_y):
@@ -39,8 +64,57 @@ def line_intersection(p0_x, p0_y, p1_x, p1_y, p2_x, p2_y, p3_x, p3_y):
     return i_x, i_y
 
 
+def line_intersections(p0_x, p0_y, p1_x, p1_y, p2_x, p2_y, p3_x, p3_y):
+    """Batch version of line_intersection, testing one segment p0-p1 against
+    many segments whose endpoints are given as numpy arrays.  Returns a boolean
+    array that is true wherever line_intersection would report a collision."""
+    s10_x = p1_x - p0_x
+    s10_y = p1_y - p0_y
+    s32_x = p3_x - p2_x
+    s32_y = p3_y - p2_y
+
+    denom = s10_x * s32_y - s32_x * s10_y
+    denomPositive = denom > 0
+
+    s02_x = p0_x - p2_x
+    s02_y = p0_y - p2_y
+    s_numer = s10_x * s02_y - s10_y * s02_x
+    t_numer = s32_x * s02_y - s32_y * s02_x
+
+    return ((denom != 0.0)
+            & ((s_numer < 0) != denomPositive)
+            & ((t_numer < 0) != denomPositive)
+            & ((s_numer > denom) != denomPositive)
+            & ((t_numer > denom) != denomPositive))
+
+
+def segment_meets_rect(ax, ay, bx, by, x1, y1, x2, y2):
+    """Liang-Barsky clip of the segment from a to b against the rectangle.
+    Also used by penrose-robinson.py."""
+    t0 = 0.0
+    t1 = 1.0
+    dx = bx - ax
+    dy = by - ay
+    for p, q in ((-dx, ax - x1), (dx, x2 - ax), (-dy, ay - y1), (dy, y2 - ay)):
+        if p == 0.0:
+            if q < 0.0:
+                return False
+        elif p < 0.0:
+            t = q / p
+            if t > t1:
+                return False
+            t0 = max(t0, t)
+        else:
+            t = q / p
+            if t < t0:
+                return False
+            t1 = min(t1, t)
+    return True
+
+
 class QuadTree(object):
     SPLIT_THRESHOLD = 8
+    BULK_THRESHOLD = 64
     
     def __init__(self, x1, y1, x2, y2):
         self.x1 = x1
@@ -52,25 +126,120 @@ class QuadTree(object):
         self.points = []
         self.quads = [None,None,None,None]
     
+    @classmethod
+    def bulk_load(cls, points, x1, y1, x2, y2):
+        """Build a tree from a sequence of points in one pass.  If the points
+        all lie within the bounds, the resulting tree is identical to one built
+        by adding the points in order.  With numpy, the coordinates are packed
+        into arrays and nodes with more than BULK_THRESHOLD points are split
+        into quadrants all at once."""
+        points = list(points)
+        root = cls(x1, y1, x2, y2)
+        if points:
+            root.grow_to(min(p.x for p in points), min(p.y for p in points))
+            root.grow_to(max(p.x for p in points), max(p.y for p in points))
+        
+        work = []
+        if numpy is not None and len(points) > cls.BULK_THRESHOLD:
+            xs = numpy.fromiter((p.x for p in points), float, len(points))
+            ys = numpy.fromiter((p.y for p in points), float, len(points))
+            bulk_work = [(root, numpy.arange(len(points)))]
+            while bulk_work:
+                node, indexes = bulk_work.pop()
+                if len(indexes) <= cls.BULK_THRESHOLD:
+                    work.append((node, [points[i] for i in indexes.tolist()]))
+                    continue
+                node.points.extend(points[i] for i in indexes[:QuadTree.SPLIT_THRESHOLD].tolist())
+                
+                rest = indexes[QuadTree.SPLIT_THRESHOLD:]
+                quad_pos = (xs[rest] >= node.mpx) + 2 * (ys[rest] >= node.mpy)
+                for pos in range(4):
+                    part = rest[quad_pos == pos]
+                    if len(part) > 0:
+                        node.quads[pos] = cls(*node.get_quad_bounds(pos))
+                        bulk_work.append((node.quads[pos], part))
+        else:
+            work.append((root, points))
+        
+        while work:
+            node, points = work.pop()
+            head = points[:QuadTree.SPLIT_THRESHOLD]
+            node.points.extend(head)
+            
+            parts = [[], [], [], []]
+            for p in points[QuadTree.SPLIT_THRESHOLD:]:
+                parts[node.get_quad_pos(p.x, p.y)].append(p)
+            for pos in range(4):
+                if parts[pos]:
+                    node.quads[pos] = cls(*node.get_quad_bounds(pos))
+                    work.append((node.quads[pos], parts[pos]))
+        
+        return root
+    
+    def grow_to(self, x, y):
+        """Double the bounds towards (x, y) until they contain it.  The
+        existing contents are pushed down into one quadrant of the enlarged
+        node, so that lookups stay logarithmic however far the points range."""
+        while x < self.x1 or x > self.x2 or y < self.y1 or y > self.y2:
+            old = QuadTree(self.x1, self.y1, self.x2, self.y2)
+            old.points = self.points
+            old.quads = self.quads
+            
+            width = (self.x2 - self.x1) or 1.0
+            height = (self.y2 - self.y1) or 1.0
+            pos = 0
+            if x < self.x1:
+                self.x1 -= width
+                self.mpx = old.x1
+                pos += 1
+            else:
+                self.x2 += width
+                self.mpx = old.x2
+            if y < self.y1:
+                self.y1 -= height
+                self.mpy = old.y1
+                pos += 2
+            else:
+                self.y2 += height
+                self.mpy = old.y2
+            
+            self.points = []
+            self.quads = [None,None,None,None]
+            self.quads[pos] = old
+    
     def add(self, point):
-        if len(self.points) < QuadTree.SPLIT_THRESHOLD:
-            self.points.append(point)
-            return
+        self.grow_to(point.x, point.y)
         
-        quad = self.get_quad(point)
-        quad.add(point)
+        node = self
+        while len(node.points) >= QuadTree.SPLIT_THRESHOLD:
+            node = node.get_quad(point)
+        
+        node.points.append(point)
     
-    def get_quad(self, point):
-        if point.y < self.mpy:
-            if point.x < self.mpx:
-                quad_pos = 0
+    def remove(self, point):
+        node = self
+        while node is not None:
+            for k in range(len(node.points)):
+                if node.points[k] is point:
+                    del node.points[k]
+                    return True
+            node = node.quads[node.get_quad_pos(point.x, point.y)]
+        return False
+    
+    def get_quad_pos(self, x, y):
+        if y < self.mpy:
+            if x < self.mpx:
+                return 0
             else:
-                quad_pos = 1
+                return 1
         else:
-            if point.x < self.mpx:
-                quad_pos = 2
+            if x < self.mpx:
+                return 2
             else:
-                quad_pos = 3
+                return 3
+    
+    def get_quad(self, point):
+        quad_pos = self.get_quad_pos(point.x, point.y)
         
         if self.quads[quad_pos] is None:
             bounds = self.get_quad_bounds(quad_pos)
@@ -88,24 +257,215 @@ class QuadTree(object):
         else:
             return self.mpx, self.mpy, self.x2, self.y2
     
+    def visit(self, x1, y1, x2, y2, callback):
+        """Call callback on each point in the rectangle, in the same order as
+        find.  If the callback returns a true value the walk stops and that
+        point is returned; otherwise None is returned."""
+        for p in self.iter_find(x1, y1, x2, y2):
+            if callback(p):
+                return p
+        return None
+    
+    def iter_find(self, x1, y1, x2, y2):
+        """Generate each point in the rectangle, without building a list."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if x1 > node.x2 or y1 > node.y2 or x2 < node.x1 or y2 < node.y1:
+                continue
+            
+            for p in node.points:
+                if p.x >= x1 and p.y >= y1 and p.x <= x2 and p.y <= y2:
+                    yield p
+            
+            quads = node.quads
+            for pos in (3, 2, 1, 0):
+                if quads[pos] is not None:
+                    stack.append(quads[pos])
+    
     def find(self, x1, y1, x2, y2):
-        if x1 > self.x2 or y1 > self.y2 or x2 < self.x1 or y2 < self.y1:
-            return []
+        return list(self.iter_find(x1, y1, x2, y2))
+    
+    def find_all(self):
+        return self.find(self.x1, self.y1, self.x2, self.y2)
+
+
+class SnapIndex(object):
+    """Hash of anchors keyed on their position and angle quantised to cells
+    twice the size of the matching tolerances, so that any anchor within
+    tolerance of a query is found by probing at most two cells per axis."""
+    
+    def __init__(self, tolerance=1.0, angle_tolerance=10.0):
+        self.tolerance = tolerance
+        self.angle_tolerance = angle_tolerance
+        self.cells = {}
+    
+    def get_range(self, v, tolerance):
+        size = 2.0 * tolerance
+        return range(int(math.floor((v - tolerance) / size)), int(math.floor((v + tolerance) / size)) + 1)
+    
+    def get_key(self, anchor):
+        return (int(math.floor(anchor.x / (2.0 * self.tolerance))),
+                int(math.floor(anchor.y / (2.0 * self.tolerance))),
+                int(math.floor(anchor.angle / (2.0 * self.angle_tolerance))))
+    
+    def add(self, anchor):
+        self.cells.setdefault(self.get_key(anchor), []).append(anchor)
+    
+    def remove(self, anchor):
+        self.cells[self.get_key(anchor)].remove(anchor)
+    
+    def find(self, x, y, angle, exact=False):
+        """Find an anchor within tolerance of the position and angle, or whose
+        angle is exactly the same if exact is set."""
+        tol = self.tolerance
+        atol = self.angle_tolerance
+        cells = self.cells
+        for kx in self.get_range(x, tol):
+            for ky in self.get_range(y, tol):
+                for ka in self.get_range(angle, atol):
+                    for c in cells.get((kx, ky, ka), ()):
+                        if (x - tol <= c.x <= x + tol and y - tol <= c.y <= y + tol
+                                and angle - atol < c.angle < angle + atol
+                                and (not exact or c.angle == angle)):
+                            return c
+        return None
+
+
+class SegmentCache(object):
+    """Start and end points and angles of every anchor's edge, kept in typed
+    arrays indexed by Anchor.index so candidates can be tested in bulk."""
+    
+    def __init__(self):
+        self.x1 = array('d')
+        self.y1 = array('d')
+        self.x2 = array('d')
+        self.y2 = array('d')
+        self.angles = array('d')
+    
+    def add(self, anchor):
+        anchor.index = len(self.angles)
+        dx, dy = anchor.get_direction()
+        self.x1.append(anchor.x)
+        self.y1.append(anchor.y)
+        self.x2.append(anchor.x + anchor.edge_type.length * dx)
+        self.y2.append(anchor.y + anchor.edge_type.length * dy)
+        self.angles.append(anchor.angle)
+    
+    def collides(self, indexes, x, y, x2, y2, angle):
+        if len(indexes) == 0:
+            return False
         
-        points = [p for p in self.points if p.x >= x1 and p.y >= y1 and p.x <= x2 and p.y <= y2]
+        angles = numpy.frombuffer(self.angles)[indexes]
+        adiff = numpy.abs(angle - angles)
+        indexes = indexes[(adiff >= 10.0) & (adiff < 350.0)]
         
-        for quad in self.quads:
-            if quad is not None:
-                points.extend(quad.find(x1, y1, x2, y2))
+        hits = line_intersections(x, y, x2, y2,
+                numpy.frombuffer(self.x1)[indexes], numpy.frombuffer(self.y1)[indexes],
+                numpy.frombuffer(self.x2)[indexes], numpy.frombuffer(self.y2)[indexes])
+        return bool(hits.any())
+
+
+class SegmentGrid(object):
+    """Uniform grid of anchors filed under every cell their edge passes
+    through, so that a query only meets edges sharing a cell with it.  Cells
+    are widened slightly when testing a segment against them, so an edge and
+    a query that cross on a cell boundary always share a cell.  Cells about
+    the length of the longest edge keep each edge to a few cells."""
+    
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.margin = cell_size * 1e-6
+        self.cells = {}
+    
+    def get_cells(self, x1, y1, x2, y2):
+        size = self.cell_size
+        margin = self.margin
+        kx1 = int(math.floor((min(x1, x2) - margin) / size))
+        kx2 = int(math.floor((max(x1, x2) + margin) / size))
+        ky1 = int(math.floor((min(y1, y2) - margin) / size))
+        ky2 = int(math.floor((max(y1, y2) + margin) / size))
+        if kx1 == kx2 and ky1 == ky2:
+            return [(kx1, ky1)]
         
-        return points
+        cells = []
+        for kx in range(kx1, kx2 + 1):
+            for ky in range(ky1, ky2 + 1):
+                if segment_meets_rect(x1, y1, x2, y2, kx * size - margin, ky * size - margin, (kx + 1) * size + margin, (ky + 1) * size + margin):
+                    cells.append((kx, ky))
+        return cells
     
-    def find_all(self):
-        return self.find(self.x1, self.y1, self.x2, self.y2)
+    def get_anchor_cells(self, anchor):
+        dx, dy = anchor.get_direction()
+        return self.get_cells(anchor.x, anchor.y, anchor.x + anchor.edge_type.length * dx, anchor.y + anchor.edge_type.length * dy)
+    
+    def add(self, anchor):
+        for key in self.get_anchor_cells(anchor):
+            self.cells.setdefault(key, []).append(anchor)
+    
+    def remove(self, anchor):
+        for key in self.get_anchor_cells(anchor):
+            self.cells[key].remove(anchor)
+    
+    def find(self, x1, y1, x2, y2):
+        """Return the anchors whose edges share a cell with the segment, each
+        once, in the order they are found."""
+        found = []
+        seen = set()
+        cells = self.cells
+        for key in self.get_cells(x1, y1, x2, y2):
+            for c in cells.get(key, ()):
+                if c not in seen:
+                    seen.add(c)
+                    found.append(c)
+        return found
 
 
 class TileError(Exception):
-    pass
+    def __init__(self, message, reason=None):
+        super(TileError, self).__init__(message)
+        self.reason = reason
+
+
+class Metrics(object):
+    """Counters and timers for a board's hot paths.  A board only records
+    them when given a Metrics object, so there is no cost otherwise."""
+    
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.timers = collections.defaultdict(float)
+    
+    def count(self, name, n=1):
+        self.counters[name] += n
+    
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+    
+    def call(self, name, f, *args):
+        """Call f, counting the call and timing it under name."""
+        start_time = time.time()
+        try:
+            return f(*args)
+        finally:
+            self.timers[name] += time.time() - start_time
+            self.counters[name] += 1
+    
+    def as_dict(self):
+        return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+    
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+    
+    def summary(self):
+        lines = []
+        for name in sorted(self.counters):
+            lines.append('%-30s %10d' % (name, self.counters[name]))
+        for name in sorted(self.timers):
+            line = '%-30s %10.3fs' % (name, self.timers[name])
+            if self.counters.get(name):
+                line += '  (%.1fus each)' % (self.timers[name] / self.counters[name] * 1e6)
+            lines.append(line)
+        return '\n'.join(lines)
 
 
 class EdgeType(object):
@@ -133,28 +493,100 @@ class Shape(object):
         angles = types_and_angles[1::2]
         for t, a in zip(types, angles):
             self.edges.append((t, a))
+        self.offsets = {}
+        self.step_offsets = {}
+    
+    def get_offsets(self, edge_type):
+        """Vertex positions of this shape when placed on an anchor of the given
+        type lying at the origin with angle 0.  Each entry is (dx, dy,
+        edge_angle, edge_type) for the next edge around the piece; None is
+        returned if the shape has no edge of that type.  Cached per type."""
+        if edge_type in self.offsets:
+            return self.offsets[edge_type]
+        
+        edges = self.edges
+        offsets = None
+        for i in range(len(edges)):
+            if edges[i][1] == edge_type:
+                offsets = []
+                x = 0.0
+                y = 0.0
+                angle = 0.0
+                prev_edge_type = edge_type
+                for j in range(i + 1, i + len(edges)):
+                    edge_angle, next_edge_type = edges[j % len(edges)]
+                    x += prev_edge_type.length * math.cos(math.radians(angle))
+                    y += prev_edge_type.length * math.sin(math.radians(angle))
+                    angle += edge_angle
+                    offsets.append((x, y, edge_angle, next_edge_type))
+                    prev_edge_type = next_edge_type
+                break
+        
+        self.offsets[edge_type] = offsets
+        return offsets
+    
+    def get_step_offsets(self, edge_type, step):
+        """As get_offsets, but already rotated for an anchor pointing in the
+        direction of the given step, and with each edge's absolute direction
+        given as a step.  Cached per type and step."""
+        key = (edge_type, step)
+        if key in self.step_offsets:
+            return self.step_offsets[key]
+        
+        offsets = self.get_offsets(edge_type)
+        step_offsets = None
+        if offsets is not None:
+            step_offsets = []
+            cos_a, sin_a = STEP_DIRECTIONS[step]
+            for dx, dy, edge_angle, next_edge_type in offsets:
+                step = (step + angle_to_step(edge_angle)) % NUM_STEPS
+                step_offsets.append((dx * cos_a - dy * sin_a, dx * sin_a + dy * cos_a, step, next_edge_type))
+        
+        self.step_offsets[key] = step_offsets
+        return step_offsets
 
 
 class Anchor(object):
-    def __init__(self, x, y, angle, edge_type):
+    __slots__ = ('x', 'y', 'angle', 'step', 'edge_type', 'piece', 'twin', 'index', 'removed')
+    
+    def __init__(self, x, y, angle, edge_type, step=None):
+        if step is not None:
+            angle = step * STEP_ANGLE
         self.x = x
         self.y = y
         self.angle = angle
+        self.step = step
         self.edge_type = edge_type
         self.piece = None
         self.twin = None
+        self.index = None
+        self.removed = False
+    
+    def set_step(self):
+        """Switch this anchor to exact-angle mode."""
+        self.step = angle_to_step(self.angle)
+        self.angle = self.step * STEP_ANGLE
+    
+    def get_direction(self):
+        if self.step is not None:
+            return STEP_DIRECTIONS[self.step]
+        return math.cos(math.radians(self.angle)), math.sin(math.radians(self.angle))
     
     def get_twin(self):
         if self.twin is not None:
             return self.twin
         
-        x2 = self.x + self.edge_type.length * math.cos(math.radians(self.angle))
-        y2 = self.y + self.edge_type.length * math.sin(math.radians(self.angle))
-        angle2 = self.angle + 180.0
-        if angle2 >= 360.0:
-            angle2 -= 360.0
+        dx, dy = self.get_direction()
+        x2 = self.x + self.edge_type.length * dx
+        y2 = self.y + self.edge_type.length * dy
         type2 = list(self.edge_type.matches)[0]
-        self.twin = Anchor(x2, y2, angle2, type2)
+        if self.step is not None:
+            self.twin = Anchor(x2, y2, None, type2, step=(self.step + NUM_STEPS // 2) % NUM_STEPS)
+        else:
+            angle2 = self.angle + 180.0
+            if angle2 >= 360.0:
+                angle2 -= 360.0
+            self.twin = Anchor(x2, y2, angle2, type2)
         self.twin.twin = self
         
         return self.twin
@@ -164,175 +596,360 @@ class Anchor(object):
 
 
 class Piece(object):
+    __slots__ = ('shape', 'anchors')
+    
     def __init__(self, shape):
         self.shape = shape
         self.anchors = []
 
-i = 0
 
-class Board(object):
+class Placement(object):
+    __slots__ = ('piece', 'anchors', 'new_anchors')
+    
+    def __init__(self, piece, anchors, new_anchors):
+        self.piece = piece
+        self.anchors = anchors
+        self.new_anchors = new_anchors
+
+
+class Scheduler(object):
+    """Frontier of anchors waiting for a piece, popped in order of
+    get_priority.  Anchors that have been filled since they were pushed are
+    skipped when popped rather than removed when filled."""
+    
     def __init__(self):
+        self.queue = []
+        self.counter = 0
+    
+    def get_priority(self, anchor):
+        raise NotImplementedError
+    
+    def push(self, anchor):
+        self.counter += 1
+        heapq.heappush(self.queue, (self.get_priority(anchor), self.counter, anchor))
+    
+    def pop(self):
+        while len(self.queue) > 0:
+            anchor = heapq.heappop(self.queue)[-1]
+            if anchor.piece is None and not anchor.removed:
+                return anchor
+        return None
+    
+    def __len__(self):
+        return len(self.queue)
+
+
+class FifoScheduler(Scheduler):
+    def get_priority(self, anchor):
+        return self.counter
+
+
+class CentreScheduler(Scheduler):
+    def __init__(self, cx=50.0, cy=50.0):
+        super(CentreScheduler, self).__init__()
+        self.cx = cx
+        self.cy = cy
+    
+    def get_priority(self, anchor):
+        return (self.cx - anchor.x) * (self.cx - anchor.x) + (self.cy - anchor.y) * (self.cy - anchor.y)
+
+
+class RandomScheduler(Scheduler):
+    """Pops anchors in random order, drawn from rng or, by default, the random
+    module at the time of drawing.  The module is not stored, so the scheduler
+    can be pickled and passed to generate_batch."""
+    
+    def __init__(self, rng=None):
+        super(RandomScheduler, self).__init__()
+        self.rng = rng
+    
+    def get_priority(self, anchor):
+        if self.rng is None:
+            return random.random()
+        return self.rng.random()
+
+
+class Board(object):
+    def __init__(self, snap=False, batch=False, exact=False, scheduler=None, metrics=None, cell_size=10.0):
         self.anchors = QuadTree(0.0, 0.0, 100.0, 100.0)
-        self.anchor_queue = []
+        self.segment_grid = SegmentGrid(cell_size)
+        self.exact = exact
+        if snap:
+            self.snap_index = SnapIndex()
+        else:
+            self.snap_index = None
+        if batch:
+            if numpy is None:
+                raise ImportError('numpy is required for batch collision checks')
+            self.segments = SegmentCache()
+        else:
+            self.segments = None
+        if scheduler is None:
+            scheduler = FifoScheduler()
+        self.frontier = scheduler
         self.pieces = []
+        self.failures = 0
+        self.metrics = metrics
+        self.stats = None
     
     def add_anchor(self, anchor):
-        def get_priority(p):
-            #return (50 - p.x) * (50 - p.x) + (50 - p.y) * (50 - p.y)
-            global i
-            i += 1
-            return i
+        if self.exact and anchor.step is None:
+            anchor.set_step()
         
         self.anchors.add(anchor)
-        priority = get_priority(anchor)
-        heapq.heappush(self.anchor_queue, (priority, anchor))
+        self.segment_grid.add(anchor)
+        if self.snap_index is not None:
+            self.snap_index.add(anchor)
+        if self.segments is not None:
+            self.segments.add(anchor)
+        self.frontier.push(anchor)
         
         twin = anchor.get_twin()
         self.anchors.add(twin)
-        priority = get_priority(twin)
-        heapq.heappush(self.anchor_queue, (priority, twin))
+        self.segment_grid.add(twin)
+        if self.snap_index is not None:
+            self.snap_index.add(twin)
+        if self.segments is not None:
+            self.segments.add(twin)
+        self.frontier.push(twin)
         
-        print anchor
+        if self.metrics is not None:
+            self.metrics.count('anchors_created', 2)
     
     def get_next_anchor(self):
-        #print '\n'.join(str(x) for x in self.anchor_queue[:10])
-        if len(self.anchor_queue) == 0:
-            return None
-        anchor = heapq.heappop(self.anchor_queue)[1]
-        #print 'picked', anchor
-        return anchor
+        return self.frontier.pop()
     
     def find_anchor(self, x, y, angle):
-        candidates = self.anchors.find(x - 1.0, y - 1.0, x + 1.0, y + 1.0)
-        for c in candidates:
-            if angle - 10 < c.angle < angle + 10:
-                return c
-        return None
+        if self.metrics is not None:
+            return self.metrics.call('anchor_lookups', self.lookup_anchor, x, y, angle)
+        return self.lookup_anchor(x, y, angle)
+    
+    def lookup_anchor(self, x, y, angle):
+        if self.snap_index is not None:
+            return self.snap_index.find(x, y, angle, self.exact)
+        
+        if self.exact:
+            def matches(c):
+                return c.angle == angle
+        else:
+            def matches(c):
+                return angle - 10 < c.angle < angle + 10
+        return self.anchors.visit(x - 1.0, y - 1.0, x + 1.0, y + 1.0, matches)
     
     def check_collisions(self, x, y, angle, length):
-        candidates = self.anchors.find(x - length, y - length, x + length, y + length)
-        x2 = x + length * math.cos(math.radians(angle)) * 0.95
-        y2 = y + length * math.sin(math.radians(angle)) * 0.95
-        x = x + length * math.cos(math.radians(angle)) * 0.05
-        y = y + length * math.sin(math.radians(angle)) * 0.05
+        if self.metrics is None:
+            return self.test_collisions(x, y, angle, length)[0]
+        
+        collides, tested = self.metrics.call('collision_checks', self.test_collisions, x, y, angle, length)
+        self.metrics.count('segment_tests', tested)
+        return collides
+    
+    def test_collisions(self, x, y, angle, length):
+        """Returns whether the edge collides with another, and how many
+        candidate edges were tested to find out."""
+        if self.exact:
+            dx, dy = STEP_DIRECTIONS[int(angle / STEP_ANGLE)]
+        else:
+            dx = math.cos(math.radians(angle))
+            dy = math.sin(math.radians(angle))
+        x2 = x + length * dx * 0.95
+        y2 = y + length * dy * 0.95
+        x = x + length * dx * 0.05
+        y = y + length * dy * 0.05
+        candidates = self.segment_grid.find(x, y, x2, y2)
+        if self.segments is not None:
+            indexes = numpy.fromiter((c.index for c in candidates), numpy.intp)
+            return self.segments.collides(indexes, x, y, x2, y2, angle), len(indexes)
+        
+        tested = 0
         for c in candidates:
             adiff = abs(angle - c.angle)
             if adiff < 10.0 or adiff >= 350.0:
                 continue
-            cx2 = c.x + c.edge_type.length * math.cos(math.radians(c.angle))
-            cy2 = c.y + c.edge_type.length * math.sin(math.radians(c.angle))
+            tested += 1
+            cdx, cdy = c.get_direction()
+            cx2 = c.x + c.edge_type.length * cdx
+            cy2 = c.y + c.edge_type.length * cdy
             if line_intersection(x, y, x2, y2, c.x, c.y, cx2, cy2):
                 #print 'collision', x, y, x2, y2, c.x, c.y, cx2, cy2
-                return True
-        return False
+                return True, tested
+        return False, tested
     
-    def place_piece(self, piece, anchor):
-        if anchor.piece is not None:
-            raise TileError('Cannot place a piece on an anchor that already has one')
+    def plan_piece(self, piece, anchor):
+        """Work out where a piece would go on an anchor and check that it fits,
+        without changing the board.  Raises TileError if it does not fit,
+        otherwise returns a Placement to be passed to commit_piece."""
+        if self.metrics is None:
+            return self.compute_placement(piece, anchor)
         
-        edges = piece.shape.edges
+        try:
+            placement = self.metrics.call('plans', self.compute_placement, piece, anchor)
+        except TileError as e:
+            self.metrics.count('rejected.%s' % e.reason)
+            raise
+        self.metrics.count('accepted')
+        return placement
+    
+    def compute_placement(self, piece, anchor):
+        if anchor.piece is not None:
+            raise TileError('Cannot place a piece on an anchor that already has one', 'occupied')
         
-        start_pos = None
-        for i in range(len(edges)):
-            if edges[i][1] == anchor.edge_type:
-                start_pos = i + 1
-                end_pos = start_pos + len(edges) - 1
-                break
+        offsets = piece.shape.get_offsets(anchor.edge_type)
+        if offsets is None:
+            raise TileError('Cannot place a %s piece on an anchor of type %s' % (piece.shape.name, anchor.edge_type.name), 'no_matching_edge')
         
-        if start_pos is None:
-            raise TileError('Cannot place a %s piece on an anchor of type %s' % (piece.shape.name, anchor.edge_type.name))
+        # Compute the whole vertex ring first, with one rotation for the piece
+        ring = []
+        if anchor.step is not None:
+            for dx, dy, step, edge_type in piece.shape.get_step_offsets(anchor.edge_type, anchor.step):
+                ring.append((anchor.x + dx, anchor.y + dy, step * STEP_ANGLE, edge_type))
+        else:
+            cos_a = math.cos(math.radians(anchor.angle))
+            sin_a = math.sin(math.radians(anchor.angle))
+            angle = anchor.angle
+            for dx, dy, edge_angle, edge_type in offsets:
+                x = anchor.x + dx * cos_a - dy * sin_a
+                y = anchor.y + dx * sin_a + dy * cos_a
+                angle += edge_angle
+                if angle >= 360.0:
+                    angle -= 360.0
+                ring.append((x, y, angle, edge_type))
         
+        # Anchor lookups are cheaper than collision checks, so reject on those first
         anchors = [anchor]
         new_anchors = []
-        x = anchor.x
-        y = anchor.y
-        angle = anchor.angle
-        prev_edge_type = anchor.edge_type
-        for i in range(start_pos, end_pos):
-            pos = i % len(edges)
-            edge_angle, edge_type = edges[pos]
-            
-            print 'prev', prev_edge_type, 'edge_angle', edge_angle, 'edge_type', edge_type
-            # First move along the existing edge
-            x += prev_edge_type.length * math.cos(math.radians(angle))
-            y += prev_edge_type.length * math.sin(math.radians(angle))
-            # Then turn the angle
-            angle += edge_angle
-            if angle >= 360.0:
-                angle -= 360.0
-            
-            # Check for collisions
-            if self.check_collisions(x, y, angle, edge_type.length):
-                raise TileError('Cannot place piece that collides with another')
-            
-            # Find or create the new anchor
+        for x, y, angle, edge_type in ring:
             new_anchor = self.find_anchor(x, y, angle)
             if new_anchor is None:
                 new_anchor = Anchor(x, y, angle, edge_type)
+                if anchor.step is not None:
+                    new_anchor.set_step()
                 new_anchors.append(new_anchor)
             elif new_anchor.piece is not None:
-                raise TileError('Cannot reuse anchor that already has a piece')
+                raise TileError('Cannot reuse anchor that already has a piece', 'anchor_reused')
             if new_anchor.edge_type != edge_type:
-                raise TileError('Cannot place piece against an incompatible anchor')
+                raise TileError('Cannot place piece against an incompatible anchor', 'incompatible_anchor')
             anchors.append(new_anchor)
-            
-            prev_edge_type = edge_type
         
-        for a in anchors:
+        for x, y, angle, edge_type in ring:
+            if self.check_collisions(x, y, angle, edge_type.length):
+                raise TileError('Cannot place piece that collides with another', 'collision')
+        
+        return Placement(piece, anchors, new_anchors)
+    
+    def commit_piece(self, placement):
+        if self.metrics is not None:
+            self.metrics.count('pieces_placed')
+        piece = placement.piece
+        for a in placement.anchors:
             a.piece = piece
-        for a in new_anchors:
+        for a in placement.new_anchors:
             self.add_anchor(a)
-        piece.anchors = anchors
+        piece.anchors = placement.anchors
         self.pieces.append(piece)
         
-        return anchors
+        return placement.anchors
+    
+    def place_piece(self, piece, anchor):
+        return self.commit_piece(self.plan_piece(piece, anchor))
+    
+    def remove_anchor(self, anchor):
+        self.anchors.remove(anchor)
+        self.segment_grid.remove(anchor)
+        if self.snap_index is not None:
+            self.snap_index.remove(anchor)
+        anchor.removed = True
+    
+    def remove_piece(self, piece):
+        """Undo commit_piece, for any piece on the board.  Edges left with no
+        piece on either side are removed, and the piece's anchors on edges
+        still next to another piece are put back on the frontier and
+        returned."""
+        if self.metrics is not None:
+            self.metrics.count('pieces_removed')
+        for a in piece.anchors:
+            a.piece = None
+        reopened = []
+        for a in piece.anchors:
+            if a.twin.piece is None:
+                if not a.removed:
+                    self.remove_anchor(a)
+                    self.remove_anchor(a.twin)
+            else:
+                self.frontier.push(a)
+                reopened.append(a)
+        piece.anchors = []
+        if self.pieces[-1] is piece:
+            self.pieces.pop()
+        else:
+            self.pieces.remove(piece)
+        return reopened
 
 
-def board_to_svg(board):
-    content = ''
-    for p in board.anchors.find_all():
+def iter_svg(board):
+    """Generate the SVG document for a board in chunks, one per element."""
+    yield """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg width="100%" height="100%" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg">
+"""
+    
+    anchors = board.anchors
+    for p in anchors.iter_find(anchors.x1, anchors.y1, anchors.x2, anchors.y2):
         if p.piece is None:
-            content = content + """<g transform="translate(%f, %f) rotate(%f)">
+            yield """<g transform="translate(%f, %f) rotate(%f)">
 <circle fill="blue" cx="0" cy="0" r="%f" />
 <line stroke="%s" stroke-width="0.15" x1="0" y1="0.25" x2="%f" y2="0.25" />
 <line stroke="blue" stroke-width="0.15" x1="%f" y1="%f" x2="%f" y2="0.25" />
 </g>\n""" % (p.x, p.y, p.angle, 0.25, p.edge_type.colour, p.edge_type.length, p.edge_type.length/2, p.edge_type.length/4, p.edge_type.length/2)
         else:
-            content = content + """<g transform="translate(%f, %f) rotate(%f)">
+            yield """<g transform="translate(%f, %f) rotate(%f)">
 <line stroke="silver" stroke-width="0.1" x1="0" y1="0.0" x2="%f" y2="0.0" />
 </g>\n""" % (p.x, p.y, p.angle, p.edge_type.length)
 
     for p in board.pieces:
         avgx = sum(p.x for p in p.anchors) / len(p.anchors)
         avgy = sum(p.y for p in p.anchors) / len(p.anchors)
-        content = content + """<g transform="translate(%f, %f) rotate(%f)">
+        yield """<g transform="translate(%f, %f) rotate(%f)">
 <circle fill="blue" cx="0" cy="0" r="%f" />
 </g>\n""" % (avgx, avgy, 0.0, 0.5)
     
-    svg = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg width="100%%" height="100%%" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg">
-%s</svg>
-""" % content
-    return svg
-    
+    yield """</svg>
+"""
 
-def add_random_piece(board, shapes):
-    while True:
-        anchor = board.get_next_anchor()
-        if anchor is None:
-            return
-        if anchor.piece is None:
-            break
+
+def write_svg(board, f):
+    """Write the SVG document for a board to a file-like object as it is
+    generated, without holding the whole document in memory."""
+    for chunk in iter_svg(board):
+        f.write(chunk)
+
+
+def board_to_svg(board):
+    return ''.join(iter_svg(board))
     
+
+def plan_random_piece(board, anchor, shapes):
     random.shuffle(shapes)
     for shape in shapes:
         piece = Piece(shape)
         try:
-            board.place_piece(piece, anchor)
-            return
+            return board.plan_piece(piece, anchor)
         except TileError:
             pass
-    print 'failed to place!'
+    return None
+
+
+def add_random_piece(board, shapes):
+    anchor = board.get_next_anchor()
+    if anchor is None:
+        return
+    
+    placement = plan_random_piece(board, anchor, shapes)
+    if placement is not None:
+        board.commit_piece(placement)
+        return
+    board.failures += 1
+    if board.metrics is not None:
+        board.metrics.count('dead_ends')
     #for i in range(100):
     #    shape = random.choice(shapes)
     #    piece = Piece(shape)
@@ -343,12 +960,143 @@ def add_random_piece(board, shapes):
     #        pass
 
 
-def main():
-    s = int(time.time())
-    s = 1399633315
-    print 'seed', s
-    random.seed(s)
+class BacktrackingTiler(object):
+    """Grows a board like add_random_piece, but on a dead end removes pieces
+    touching the ends of the dead end's edge, most recently placed first, and
+    rebuilds that area before moving on.  Each retry at the same place removes
+    one more piece every other time, up to depth of them.  An anchor that
+    still cannot be filled after max_retries backtracks is given up on and
+    left as a hole.  Board failures counts the holes currently open, each once
+    however many times its anchor is recreated."""
+    
+    VERTEX_TOLERANCE = 0.5
+    
+    def __init__(self, board, shapes, depth=6, max_retries=12, max_retry_keys=1024):
+        self.board = board
+        self.shapes = list(shapes)
+        self.depth = depth
+        self.max_retries = max_retries
+        # The order pieces were placed in, so the most recent can be undone
+        self.placed = {}
+        self.counter = 0
+        self.reopened = []
+        self.retries = collections.OrderedDict()
+        self.max_retry_keys = max_retry_keys
+        self.holes = set()
+        self.open_holes = set()
+        self.backtracks = 0
+        self.seconds = 0.0
+    
+    def get_retry_key(self, anchor):
+        # Anchors are recreated when their pieces are undone, so key on position
+        return (round(anchor.x, 3), round(anchor.y, 3), round(anchor.angle, 3))
+    
+    def get_next_anchor(self):
+        while len(self.reopened) > 0:
+            anchor = self.reopened.pop()
+            if anchor.piece is None and not anchor.removed:
+                return anchor
+        return self.board.get_next_anchor()
     
+    def get_undo_pieces(self, anchor, retries):
+        """Return the pieces to remove for a dead end: those with a corner at
+        either end of the anchor's edge, most recent first."""
+        dx, dy = anchor.get_direction()
+        length = anchor.edge_type.length
+        tol = BacktrackingTiler.VERTEX_TOLERANCE
+        pieces = set()
+        for x, y in ((anchor.x, anchor.y), (anchor.x + length * dx, anchor.y + length * dy)):
+            for a in self.board.anchors.iter_find(x - tol, y - tol, x + tol, y + tol):
+                if a.piece is not None:
+                    pieces.add(a.piece)
+                if a.twin.piece is not None:
+                    pieces.add(a.twin.piece)
+        pieces = sorted(pieces, key=lambda p: self.placed.get(p, 0), reverse=True)
+        return pieces[:min(1 + retries // 2, self.depth)]
+    
+    def open_hole(self, key):
+        if key not in self.open_holes:
+            self.open_holes.add(key)
+            self.board.failures += 1
+            if self.board.metrics is not None:
+                self.board.metrics.count('dead_ends')
+    
+    def close_holes(self, anchors):
+        """Stop counting holes whose anchors have been filled or undone."""
+        if len(self.open_holes) == 0:
+            return
+        for a in anchors:
+            key = self.get_retry_key(a)
+            if key in self.open_holes:
+                self.open_holes.remove(key)
+                self.board.failures -= 1
+    
+    def step(self):
+        """Fill one anchor, backtracking if necessary.  Returns False once the
+        frontier is empty."""
+        board = self.board
+        anchor = self.get_next_anchor()
+        if anchor is None:
+            return False
+        
+        placement = plan_random_piece(board, anchor, list(self.shapes))
+        if placement is not None:
+            board.commit_piece(placement)
+            self.counter += 1
+            self.placed[placement.piece] = self.counter
+            self.close_holes(placement.anchors)
+            return True
+        
+        key = self.get_retry_key(anchor)
+        if key in self.holes:
+            self.open_hole(key)
+            return True
+        retries = self.retries.pop(key, 0)
+        pieces = self.get_undo_pieces(anchor, retries)
+        # Never undo the whole board, which would leave nothing to grow from
+        if retries >= self.max_retries or len(pieces) == 0 or len(pieces) >= len(board.pieces):
+            self.holes.add(key)
+            self.open_hole(key)
+            return True
+        
+        # Retry counts are only needed while the frontier is nearby, so the
+        # least recently used are dropped
+        self.retries[key] = retries + 1
+        if len(self.retries) > self.max_retry_keys:
+            self.retries.popitem(last=False)
+        self.backtracks += 1
+        if board.metrics is not None:
+            board.metrics.count('backtracks')
+        reopened = [anchor]
+        for piece in pieces:
+            anchors = piece.anchors
+            reopened.extend(board.remove_piece(piece))
+            del self.placed[piece]
+            self.close_holes(b for a in anchors for b in (a, a.twin) if b.removed)
+        # Retry the dead end first, then the undone pieces' anchors
+        reopened.reverse()
+        self.reopened.extend(reopened)
+        return True
+    
+    def grow(self, num_pieces):
+        start_time = time.time()
+        while len(self.board.pieces) < num_pieces and self.step():
+            pass
+        self.seconds += time.time() - start_time
+    
+    def get_stats(self):
+        pieces = len(self.board.pieces)
+        return {
+            'pieces': pieces,
+            'failures': self.board.failures,
+            'backtracks': self.backtracks,
+            'seconds': self.seconds,
+            'pieces_per_second': pieces / self.seconds if self.seconds > 0 else 0.0,
+            'backtracks_per_piece': float(self.backtracks) / pieces if pieces > 0 else 0.0,
+        }
+
+
+def kite_and_dart():
     # Thin and thick rhombi
     #edge1 = EdgeType('spike-blue', 5.0).set_colour('blue')
     #edge2 = EdgeType('blue-dip', 5.0, edge1).set_colour('darkblue')
@@ -366,17 +1114,136 @@ def main():
     shape1 = Shape('kite', 108.0, edge1, 108.0, edge2, 36.0, edge3, 108.0, edge4)
     shape2 = Shape('dart', -36.0, edge3, 144.0, edge1, 108.0, edge4, 144.0, edge2)
     
-    board = Board()
+    return [edge1, edge2, edge3, edge4], [shape1, shape2]
+
+
+def grow_board(seed, num_pieces, snap=False, batch=False, exact=False, scheduler=None, backtrack=None, metrics=None):
+    random.seed(seed)
+    
+    edges, shapes = kite_and_dart()
+    
+    cell_size = max(e.length for e in edges)
+    board = Board(snap=snap, batch=batch, exact=exact, scheduler=scheduler, metrics=metrics, cell_size=cell_size)
     
-    seed = Anchor(50.0, 50.0, 0.0, edge1)
+    seed = Anchor(50.0, 50.0, 0.0, edges[0])
     board.add_anchor(seed)
     
-    for i in range(100):
-        add_random_piece(board, [shape1, shape2])
+    if backtrack is not None:
+        tiler = BacktrackingTiler(board, shapes, depth=backtrack)
+        tiler.grow(num_pieces)
+        board.stats = tiler.get_stats()
+        return board
+    
+    for i in range(num_pieces):
+        add_random_piece(board, list(shapes))
+    
+    return board
+
+
+def generate_board(args):
+    """Grow and render one board of a batch.  Takes a single tuple so it can
+    be mapped over a process pool.  Tasks are pickled in chunks, so the
+    options are copied to give each board its own scheduler."""
+    seed, num_pieces, output_dir, metrics, options = args
+    options = copy.deepcopy(options)
+    if metrics:
+        options['metrics'] = Metrics()
+    
+    start_time = time.time()
+    board = grow_board(seed, num_pieces, **options)
+    grow_time = time.time() - start_time
+    
+    start_time = time.time()
+    path = os.path.join(output_dir, 'penrose-%d.svg' % seed)
+    f = open(path, 'wt')
+    write_svg(board, f)
+    f.close()
+    render_time = time.time() - start_time
+    
+    result = {
+        'seed': seed,
+        'path': path,
+        'pieces': len(board.pieces),
+        'failures': board.failures,
+        'grow_seconds': grow_time,
+        'render_seconds': render_time,
+    }
+    if board.metrics is not None:
+        result['metrics'] = board.metrics.as_dict()
+    if board.stats is not None:
+        result['stats'] = board.stats
+    return result
+
+
+def generate_batch(seeds, num_pieces, output_dir, processes=None, metrics=False, **options):
+    """Generate a board for each seed on a pool of worker processes, writing
+    each to output_dir/penrose-<seed>.svg.  Each board depends only on its
+    seed.  Returns a list of per-board results in seed order, including each
+    board's own metrics if metrics is set."""
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    
+    tasks = [(seed, num_pieces, output_dir, metrics, options) for seed in seeds]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(generate_board, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grow Penrose kite and dart tilings')
+    parser.add_argument('--seeds', help='generate a batch of boards for seeds START:END')
+    parser.add_argument('--pieces', type=int, default=100, help='number of pieces to attempt per board')
+    parser.add_argument('--output-dir', default='.', help='directory for batch output')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--metrics', action='store_true', help='collect and print placement metrics')
+    parser.add_argument('--metrics-json', help='collect placement metrics and write them to this file as JSON')
+    parser.add_argument('--backtrack', type=int, metavar='DEPTH', help='undo up to DEPTH pieces around each dead end and print tiler stats')
+    args = parser.parse_args()
+    
+    options = {}
+    if args.backtrack is not None:
+        options['backtrack'] = args.backtrack
+    metrics = args.metrics or args.metrics_json is not None
+    
+    if args.seeds is not None:
+        start, end = [int(x) for x in args.seeds.split(':')]
+        results = generate_batch(range(start, end), args.pieces, args.output_dir, args.processes, metrics, **options)
+        for r in results:
+            print 'seed %(seed)d: %(pieces)d pieces, %(failures)d failures, grown in %(grow_seconds).3fs, rendered in %(render_seconds).3fs -> %(path)s' % r
+            if 'stats' in r:
+                print '    %(backtracks)d backtracks, %(backtracks_per_piece).3f per piece, %(pieces_per_second).1f pieces/s' % r['stats']
+        if args.metrics_json:
+            f = open(args.metrics_json, 'wt')
+            json.dump([r.get('metrics') for r in results], f, indent=2, sort_keys=True)
+            f.close()
+        return
+    
+    s = int(time.time())
+    s = 1399633315
+    print 'seed', s
+    
+    if metrics:
+        options['metrics'] = Metrics()
+    board = grow_board(s, args.pieces, **options)
     
     f = open('penrose.svg', 'wt')
-    f.write(board_to_svg(board))
+    write_svg(board, f)
     f.close()
+    
+    if board.stats is not None:
+        for k in sorted(board.stats):
+            print '%s: %s' % (k, board.stats[k])
+    if args.metrics:
+        print board.metrics.summary()
+    if args.metrics_json:
+        f = open(args.metrics_json, 'wt')
+        f.write(board.metrics.to_json())
+        f.close()
 
 
 if __name__ == '__main__':
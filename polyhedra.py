@@ -1,101 +1,399 @@
+import re
 import sys
 import math
-import tokenize
-from StringIO import StringIO
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def translate(p, a, l):
     x,y = p
     return x + math.cos(a) * l, y + math.sin(a) * l
 
 
-def polygon(pt, num, layers=[0]):
+class PolygonTable(object):
+    """Positions around a regular polygon of unit side, starting from the
+    middle of an edge at the origin facing angle 0: the middle of each edge,
+    each vertex, and the inward step from each vertex per unit of layer
+    offset.  A face at (x,y,a,z) is this rotated by a, scaled by z and moved
+    to (x,y); layer offsets are not scaled."""
+    
+    def __init__(self, num):
+        self.num = num
+        self.da = math.pi*2.0 / num
+        f = 1/math.cos(self.da/2.0)
+        self.midpoints = []
+        self.vertices = []
+        self.steps = []
+        x,y,a = 0.0,0.0,0.0
+        for i in range(num):
+            self.midpoints.append((x,y))
+            x,y = translate((x,y), a+math.pi/2.0, 0.5)
+            self.vertices.append((x,y))
+            self.steps.append(translate((0.0,0.0), a - self.da/2.0, f))
+            a -= self.da
+            x,y = translate((x,y), a+math.pi/2.0, 0.5)
+        
+        if numpy is not None:
+            self.vertex_array = numpy.array(self.vertices)
+            self.step_array = numpy.array(self.steps)
+
+polygon_tables = {}
+
+def get_polygon_table(num):
+    if num not in polygon_tables:
+        polygon_tables[num] = PolygonTable(num)
+    return polygon_tables[num]
+
+
+class Face(object):
+    """A polygon waiting to be drawn; ShapeRenderer draws faces in batches."""
+    __slots__ = ['x', 'y', 'a', 'z', 'num', 'layers']
+    
+    def __init__(self, x, y, a, z, num, layers):
+        self.x = x
+        self.y = y
+        self.a = a
+        self.z = z
+        self.num = num
+        self.layers = layers
+
+
+def get_path_format(num, num_layers, precision):
+    point = '%%.%df,%%.%df' % (precision, precision)
+    layer = 'M %s Z' % ' '.join([point] * num)
+    return """<path fill-rule="evenodd" d="%s" />\n""" % ' '.join([layer] * num_layers)
+
+def render_faces(faces, precision=6):
+    """Return the path for each face.  Faces with the same number of sides
+    and layers are computed together with numpy if it is available."""
+    groups = {}
+    for i, face in enumerate(faces):
+        groups.setdefault((face.num, tuple(face.layers)), []).append(i)
+    
+    paths = [None] * len(faces)
+    for (num, layers), indexes in groups.items():
+        table = get_polygon_table(num)
+        path_format = get_path_format(num, len(layers), precision)
+        if numpy is not None:
+            group = [faces[i] for i in indexes]
+            x = numpy.array([face.x for face in group])
+            y = numpy.array([face.y for face in group])
+            a = numpy.array([face.a for face in group])
+            z = numpy.array([face.z for face in group])
+            # Rotation of each face, as (face, 2, 2)
+            c = numpy.cos(a)
+            s = numpy.sin(a)
+            rotation = numpy.array([[c, -s], [s, c]]).transpose(2, 0, 1)
+            vertices = numpy.einsum('fij,nj->fni', rotation, table.vertex_array) * z[:, None, None]
+            vertices += numpy.stack([x, y], axis=1)[:, None, :]
+            steps = numpy.einsum('fij,nj->fni', rotation, table.step_array)
+            # Points of each face as (face, layer, vertex, 2)
+            points = vertices[:, None, :, :] + numpy.array(layers)[None, :, None, None] * steps[:, None, :, :]
+            for i, row in zip(indexes, points.reshape(len(group), -1).tolist()):
+                paths[i] = path_format % tuple(row)
+        else:
+            for i in indexes:
+                face = faces[i]
+                c = math.cos(face.a)
+                s = math.sin(face.a)
+                row = []
+                for offset in layers:
+                    for (vx, vy), (sx, sy) in zip(table.vertices, table.steps):
+                        row.append(face.x + face.z*(c*vx - s*vy) + offset*(c*sx - s*sy))
+                        row.append(face.y + face.z*(s*vx + c*vy) + offset*(s*sx + c*sy))
+                paths[i] = path_format % tuple(row)
+    return paths
+
+
+def polygon(pt, write, num, layers=[0]):
     x,y,a,z = pt
+    write(Face(x, y, a, z, num, layers))
+    table = get_polygon_table(num)
+    c = math.cos(a)
+    s = math.sin(a)
     pts = []
-    params = [[] for offset in layers]
-    da = math.pi*2.0 / num
-    f = 1/math.cos(da/2.0)
-    for i in range(num):
-        pts.append((x,y,a+math.pi,z))
-        x,y = (translate((x,y), a+math.pi/2.0, z*0.5))
-        j = 0
-        for offset in layers:
-            params[j].append(translate((x,y), a - da/2.0, f*offset))
-            j += 1
-        a -= da
-        x,y = (translate((x,y), a+math.pi/2.0, z*0.5))
-    ps = []
-    for param in params:
-        ps.append('M %s Z' % ' '.join(['%f,%f' % p for p in param]))
-    print """<path fill-rule="evenodd" d="%s" />""" % ' '.join(ps)
+    for i, (mx, my) in enumerate(table.midpoints):
+        pts.append((x + z*(c*mx - s*my), y + z*(s*mx + c*my), a - i*table.da + math.pi, z))
     return pts
 
-def p4(pt):
-    return polygon(pt, 4, [0, 0.1, 0.5, 1.0])
+def p4(pt, write):
+    return polygon(pt, write, 4, [0, 0.1, 0.5, 1.0])
 
-def p6(pt):
-    return polygon(pt, 6, [0, 0.1, 0.5, 1.0])
+def p6(pt, write):
+    return polygon(pt, write, 6, [0, 0.1, 0.5, 1.0])
 
-def p8(pt):
-    return polygon(pt, 8, [0, 0.1, 0.5, 1.0])
+def p8(pt, write):
+    return polygon(pt, write, 8, [0, 0.1, 0.5, 1.0])
 
-def e(pt):
+def e(pt, write):
     x,y,a,z = pt
     x1,y1 = translate(translate((x,y), a+math.pi/2.0, z*0.5), a, 1.0)
     x2,y2 = translate(translate((x,y), a-math.pi/2.0, z*0.5), a, 1.0)
     #print """<path stroke="black" d="M %f,%f L %f,%f" />""" % (x1,y1,x2,y2)
     return []
 
-def s(pt):
+def s(pt, write):
     x,y,a,z = pt
     x1,y1 = translate((x,y), a+math.pi/2.0, z*0.5)
     x2,y2 = translate((x,y), a-math.pi/2.0, z*0.5)
     #print """<path stroke="silver" d="M %f,%f L %f,%f" />""" % (x1,y1,x2,y2)
     return []
 
-def draw_shape(points, shape_data, functions):
-    points = points[:]
-    outpoints = []
-    instrs = tokenize.generate_tokens(StringIO(shape_data).next)
-    stack = [None]
-    for type,instr,start,end,line in instrs:
-        #print >>sys.stderr, 'instr:', instr
-        if instr == '(':
-            stack.append(points)
-            points = outpoints
-            outpoints = []
-        elif instr == ')' or instr == '':
-            while len(outpoints) > 0:
-                if len(outpoints) == num_outpoints:
-                    f = functions['s']
-                else:
-                    f = functions['e']
-                inpoint = outpoints.pop(0)
-                f(inpoint)
-            while len(points) > 0:
-                f = functions['e']
-                inpoint = points.pop(0)
-                f(inpoint)
-            outpoints = points
-            points = stack.pop()
-        else:
-            while len(outpoints) > 0:
-                if len(outpoints) == num_outpoints:
-                    f = functions['s']
-                else:
-                    f = functions['e']
-                inpoint = outpoints.pop(0)
-                f(inpoint)
-            f = functions[instr]
-            inpoint = points.pop(0)
-            outpoints = f(inpoint)
-            num_outpoints = len(outpoints)
-
-print """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg width="100%" height="100%" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg">"""
-point = 0.0,0.0,0.0,10.0
+SHAPE_TOKEN = re.compile(r'\s*(?:(\w+)|([()])|(\S))')
+
+compiled_shapes = {}
+
+def compile_shape(shape_data):
+    """Parse a shape string into a tuple of nodes, each a (name, children)
+    pair where children is None if the name is not followed by brackets.
+    The result is cached."""
+    if shape_data in compiled_shapes:
+        return compiled_shapes[shape_data]
+    
+    nodes = []
+    stack = []
+    for name, bracket, other in SHAPE_TOKEN.findall(shape_data):
+        if name:
+            nodes.append((name, None))
+        elif bracket == '(':
+            if not nodes or nodes[-1][1] is not None:
+                raise ValueError('Bracket without a function in %r' % shape_data)
+            stack.append(nodes)
+            nodes = []
+        elif bracket == ')':
+            if not stack:
+                raise ValueError('Unbalanced brackets in %r' % shape_data)
+            children = tuple(nodes)
+            nodes = stack.pop()
+            nodes[-1] = (nodes[-1][0], children)
+        elif other:
+            raise ValueError('Unexpected %r in %r' % (other, shape_data))
+    if stack:
+        raise ValueError('Unbalanced brackets in %r' % shape_data)
+    
+    result = tuple(nodes)
+    compiled_shapes[shape_data] = result
+    return result
+
+def find_repeats(nodes, counts=None):
+    """Return the set of nodes with children that occur more than once in
+    the tree."""
+    top = counts is None
+    if top:
+        counts = {}
+    for node in nodes:
+        name, children = node
+        if children is not None:
+            counts[node] = counts.get(node, 0) + 1
+            find_repeats(children, counts)
+    if top:
+        return set(node for node, count in counts.items() if count > 1)
+
+def discard(part):
+    pass
+
+def check_shape(points, nodes, functions, checked=None):
+    """Raise ValueError if the nodes name a function that is not in
+    functions, or give more nodes than there are points for them.  Nodes
+    with children are run, without output, to count the points they give;
+    each is checked once, so a function must give the same number of points
+    wherever it is applied."""
+    if checked is None:
+        checked = set()
+        for name in ['s', 'e']:
+            if name not in functions:
+                raise ValueError('Missing function %r' % name)
+    if len(nodes) > len(points):
+        raise ValueError('%d shapes but only %d starting points' % (len(nodes), len(points)))
+    for point, node in zip(points, nodes):
+        name, children = node
+        if name not in functions:
+            raise ValueError('Unknown function %r' % name)
+        if children is None or node in checked:
+            continue
+        checked.add(node)
+        outpoints = functions[name](point, discard)
+        if len(children) > len(outpoints):
+            raise ValueError('%s gives %d points but has %d shapes' % (name, len(outpoints), len(children)))
+        check_shape(outpoints, children, functions, checked)
+
+class ShapeRenderer(object):
+    """Runs a compiled shape, passing the renderer's write to each function
+    for its SVG.  Functions may write strings or Faces; the output is held
+    until batch_size faces have built up, then they are all rendered at once
+    with coordinates to the given precision and everything is passed on to
+    the output write in order.
+    
+    If instance is set, a subtree that occurs more than once is rendered
+    once, at the origin, into <defs> before its first use, and every copy is
+    a <use> of it moved into place."""
+    
+    def __init__(self, functions, write, instance=True, precision=6, batch_size=10000):
+        self.functions = functions
+        self.output = write
+        self.instance = instance
+        self.precision = precision
+        self.batch_size = batch_size
+        self.repeats = set()
+        self.defs = {}
+        self.parts = []
+        self.num_faces = 0
+    
+    def render(self, points, nodes):
+        for part in self.iter_render(points, nodes):
+            self.output(part)
+    
+    def iter_render(self, points, nodes):
+        """Generate the output for the nodes, in pieces, as it is rendered."""
+        if self.instance:
+            self.repeats = find_repeats(nodes)
+        for part in self.run(points, nodes):
+            yield part
+        for part in self.flush():
+            yield part
+    
+    def write(self, part):
+        self.parts.append(part)
+        if isinstance(part, Face):
+            self.num_faces += 1
+    
+    def flush(self):
+        """Render the faces held so far and return all the held output."""
+        paths = iter(render_faces([part for part in self.parts if isinstance(part, Face)], self.precision))
+        output = []
+        for part in self.parts:
+            if isinstance(part, Face):
+                output.append(next(paths))
+            else:
+                output.append(part)
+        self.parts = []
+        self.num_faces = 0
+        return output
+    
+    def run(self, points, nodes):
+        """Apply each node to the next of the points in turn; points left over
+        at the end get 'e'.  Generates the output whenever batch_size faces
+        have built up."""
+        i = 0
+        for node in nodes:
+            if node in self.repeats:
+                parts = self.use(points[i], node)
+            else:
+                parts = self.run_node(points[i], node)
+            for part in parts:
+                yield part
+            if self.num_faces >= self.batch_size:
+                for part in self.flush():
+                    yield part
+            i += 1
+        for point in points[i:]:
+            self.functions['e'](point, self.write)
+    
+    def run_node(self, point, node):
+        """Apply the node's function to the point, then its children to the
+        points that returns.  If it has no children, the first of those gets
+        's' and the rest 'e'."""
+        name, children = node
+        outpoints = self.functions[name](point, self.write)
+        if children is not None:
+            for part in self.run(outpoints, children):
+                yield part
+        elif len(outpoints) > 0:
+            self.functions['s'](outpoints[0], self.write)
+            for outpoint in outpoints[1:]:
+                self.functions['e'](outpoint, self.write)
+    
+    def use(self, point, node):
+        x,y,a,z = point
+        # Nothing in a shape changes its scale, so copies only differ by it
+        # when the starting points do
+        key = (node, z)
+        if key not in self.defs:
+            self.defs[key] = 'shape%d' % len(self.defs)
+            self.write("""<defs><g id="%s">\n""" % self.defs[key])
+            for part in self.run_node((0.0, 0.0, 0.0, z), node):
+                yield part
+            self.write("""</g></defs>\n""")
+        self.write("""<use xlink:href="#%s" transform="translate(%.*f,%.*f) rotate(%.*f)" />\n""" % (self.defs[key], self.precision, x, self.precision, y, self.precision, math.degrees(a)))
+
+def draw_shape(points, shape_data, functions, write=None, instance=True, precision=6):
+    if write is None:
+        write = sys.stdout.write
+    nodes = compile_shape(shape_data)
+    check_shape(points, nodes, functions)
+    ShapeRenderer(functions, write, instance, precision).render(points, nodes)
+
 cube_data = """p4(p4 p4(s e p4 e) p4 p4)"""
 orange_data1 = """p8(p4(s e p8(s e p4 e p4 p6)) p6 p4(s e p8(s e p4 e p4 p6)) p6 p4(s e p8(s e p4 e p4 p6)) p6 p4(s e p8(s e p4 e p4(s e p8) p6)) p6)"""
 orange_data2 = """p4(p6(s e p4 p6) p6(s e p4 p6) p6(s e p4 p6) p6(s e p4 p6(s e e p4)))"""
 
-draw_shape([point], orange_data2, locals())
-print """</svg>"""
+SHAPES = {
+    'cube': cube_data,
+    'orange1': orange_data1,
+    'orange2': orange_data2,
+}
+
+FUNCTIONS = {
+    'p4': p4,
+    'p6': p6,
+    'p8': p8,
+    'e': e,
+    's': s,
+}
+
+START_POINT = 0.0,0.0,0.0,10.0
+
+def iter_svg(shape_data, point=START_POINT, functions=FUNCTIONS, instance=True, precision=6):
+    """Generate the SVG document for a shape string in pieces.  The shape is
+    compiled and checked before the first piece."""
+    nodes = compile_shape(shape_data)
+    check_shape([point], nodes, functions)
+    yield """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg width="100%" height="100%" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n"""
+    for part in ShapeRenderer(functions, None, instance, precision).iter_render([point], nodes):
+        yield part
+    yield """</svg>\n"""
+
+def render_svg(write, shape_data, **options):
+    """Render a shape string as a whole SVG document, passing it to write in
+    pieces.  Nothing is written if the shape is invalid."""
+    for part in iter_svg(shape_data, **options):
+        write(part)
+
+def write_svg(f, shape_data, **options):
+    render_svg(f.write, shape_data, **options)
+
+def main():
+    parser = argparse.ArgumentParser(description='Draw polyhedron nets as SVG')
+    parser.add_argument('shapes', nargs='*', metavar='SHAPE', help='shape string, or one of: %s (default orange2)' % ', '.join(sorted(SHAPES)))
+    parser.add_argument('-o', '--output', action='append', default=[], help='file to write the next shape to; give one per shape, or none to write a single shape to stdout')
+    parser.add_argument('--no-instance', action='store_true', help='draw every copy of a repeated part in full')
+    parser.add_argument('--precision', type=int, default=6, help='decimal places for coordinates')
+    args = parser.parse_args()
+    
+    shapes = args.shapes or ['orange2']
+    if args.output and len(args.output) != len(shapes):
+        parser.error('give one output per shape')
+    if not args.output and len(shapes) > 1:
+        parser.error('give an output for each shape')
+    
+    for shape in shapes:
+        try:
+            check_shape([START_POINT], compile_shape(SHAPES.get(shape, shape)), FUNCTIONS)
+        except ValueError, ex:
+            parser.error(str(ex))
+    
+    for i, shape in enumerate(shapes):
+        shape_data = SHAPES.get(shape, shape)
+        if args.output:
+            f = open(args.output[i], 'wt')
+            write_svg(f, shape_data, instance=not args.no_instance, precision=args.precision)
+            f.close()
+        else:
+            write_svg(sys.stdout, shape_data, instance=not args.no_instance, precision=args.precision)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,19 @@
-from unittest import TestCase
+import os
+import json
+import math
+import random
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
 
-from penrose import QuadTree
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import penrose
+from penrose import QuadTree, Board, kite_and_dart, add_random_piece, grow_board, generate_batch, board_to_svg, line_intersection, line_intersections
+from penrose import Anchor, BacktrackingTiler, CentreScheduler, FifoScheduler, RandomScheduler, Metrics, SegmentGrid
 
 class Point(object):
     def __init__(self, x, y):
@@ -10,6 +23,18 @@ class Point(object):
     def __repr__(self):
         return 'Point(%s, %s)' % (repr(self.x), repr(self.y))
 
+
+def tree_nodes(qt):
+    """List each node's bounds and points, depth first."""
+    nodes = []
+    stack = [qt]
+    while stack:
+        node = stack.pop()
+        nodes.append(((node.x1, node.y1, node.x2, node.y2), node.points))
+        stack.extend(q for q in node.quads if q is not None)
+    return nodes
+
+
 class QuadTreeTests(TestCase):
     def testEmpty(self):
         qt = QuadTree(0, 0, 100, 100)
@@ -31,3 +56,266 @@ class QuadTreeTests(TestCase):
         qt.add(pt2)
         self.assertEqual(qt.find_all(), [pt1, pt2])
         self.assertEqual(qt.find(40, 40, 60, 60), [pt1, pt2])
+
+    def testBulkLoad(self):
+        pts = [Point(x * 7 % 100, x * 13 % 100) for x in range(100)]
+        qt1 = QuadTree(0, 0, 100, 100)
+        for pt in pts:
+            qt1.add(pt)
+        qt2 = QuadTree.bulk_load(pts, 0, 0, 100, 100)
+        self.assertEqual(qt2.find_all(), qt1.find_all())
+        self.assertEqual(qt2.find(20, 20, 60, 60), qt1.find(20, 20, 60, 60))
+
+    def testBulkLoadStructure(self):
+        rng = random.Random(1)
+        pts = [Point(rng.uniform(0, 100), rng.uniform(0, 100)) for x in range(2000)]
+        qt = QuadTree(0, 0, 100, 100)
+        for pt in pts:
+            qt.add(pt)
+        self.assertEqual(tree_nodes(QuadTree.bulk_load(pts, 0, 0, 100, 100)), tree_nodes(qt))
+        saved = penrose.numpy
+        try:
+            penrose.numpy = None
+            self.assertEqual(tree_nodes(QuadTree.bulk_load(pts, 0, 0, 100, 100)), tree_nodes(qt))
+        finally:
+            penrose.numpy = saved
+
+    def testVisit(self):
+        qt = QuadTree(0, 0, 100, 100)
+        pts = [Point(x, x) for x in range(20)]
+        for pt in pts:
+            qt.add(pt)
+        seen = []
+        found = qt.visit(0, 0, 100, 100, lambda p: seen.append(p) or p.x == 10)
+        self.assertEqual(found, pts[10])
+        self.assertEqual(seen, pts[:11])
+        self.assertEqual(list(qt.iter_find(5, 5, 8, 8)), pts[5:9])
+
+    def testGrow(self):
+        qt = QuadTree(0, 0, 100, 100)
+        pts = [Point(50, 50), Point(-250, 30), Point(1000, 2000), Point(99, -7)]
+        for pt in pts:
+            qt.add(pt)
+        self.assertTrue(qt.x1 <= -250 and qt.y1 <= -7 and qt.x2 >= 1000 and qt.y2 >= 2000)
+        self.assertEqual(set(qt.find_all()), set(pts))
+        self.assertEqual(qt.find(-300, 0, -200, 50), [pts[1]])
+        self.assertEqual(qt.find(40, 40, 60, 60), [pts[0]])
+
+    def testRemove(self):
+        qt = QuadTree(0, 0, 100, 100)
+        pts = [Point(x * 7 % 100, x * 13 % 100) for x in range(100)]
+        for pt in pts:
+            qt.add(pt)
+        for pt in pts[::3]:
+            self.assertTrue(qt.remove(pt))
+        self.assertFalse(qt.remove(pts[0]))
+        self.assertEqual(set(qt.find_all()), set(pts) - set(pts[::3]))
+
+    def testGrowDepth(self):
+        qt = QuadTree(0, 0, 100, 100)
+        for x in range(1000):
+            qt.add(Point(1000.0 + x * 10, 1000.0 + x * 3))
+        depth = 0
+        nodes = [qt]
+        while nodes:
+            depth += 1
+            nodes = [q for n in nodes for q in n.quads if q is not None]
+        self.assertTrue(depth < 20)
+
+
+class IntersectionTests(TestCase):
+    @skipIf(numpy is None, 'numpy is required for batch intersections')
+    def testBatchMatchesScalar(self):
+        rng = random.Random(1)
+        for i in range(20):
+            p0 = rng.uniform(0, 10), rng.uniform(0, 10)
+            p1 = rng.uniform(0, 10), rng.uniform(0, 10)
+            segments = [[rng.uniform(0, 10) for j in range(4)] for k in range(50)]
+            # Include segments sharing an endpoint or collinear with p0-p1
+            segments.append([p0[0], p0[1], p1[0], p1[1]])
+            segments.append([p1[0], p1[1], 5.0, 5.0])
+            cols = numpy.array(segments).T
+            expected = [bool(line_intersection(p0[0], p0[1], p1[0], p1[1], *seg)) for seg in segments]
+            actual = line_intersections(p0[0], p0[1], p1[0], p1[1], *cols)
+            self.assertEqual(list(actual), expected)
+
+
+class SegmentGridTests(TestCase):
+    def testCells(self):
+        grid = SegmentGrid(4.0)
+        self.assertEqual(grid.get_cells(1.0, 1.0, 2.0, 2.0), [(0, 0)])
+        # Only the cells the segment passes through, not its whole bounding box
+        self.assertEqual(sorted(grid.get_cells(1.0, 1.0, 11.0, 7.0)), [(0, 0), (1, 0), (1, 1), (2, 1)])
+
+    def testMatchesAllEdges(self):
+        board = grow_board(1, 300)
+        anchors = board.anchors.find_all()
+        rng = random.Random(1)
+        for i in range(500):
+            x, y = rng.uniform(20, 80), rng.uniform(20, 80)
+            angle = rng.randrange(10) * 36.0
+            length = rng.choice([10.0, 6.18])
+            dx = math.cos(math.radians(angle))
+            dy = math.sin(math.radians(angle))
+            x1, y1 = x + length * dx * 0.05, y + length * dy * 0.05
+            x2, y2 = x + length * dx * 0.95, y + length * dy * 0.95
+            expected = False
+            for c in anchors:
+                adiff = abs(angle - c.angle)
+                if 10.0 <= adiff < 350.0:
+                    cdx, cdy = c.get_direction()
+                    if line_intersection(x1, y1, x2, y2, c.x, c.y, c.x + c.edge_type.length * cdx, c.y + c.edge_type.length * cdy):
+                        expected = True
+                        break
+            self.assertEqual(board.test_collisions(x, y, angle, length)[0], expected)
+
+
+def anchor_positions(board):
+    return [(a.x, a.y, a.angle, a.edge_type.name) for p in board.pieces for a in p.anchors]
+
+class BoardTests(TestCase):
+    def testSnapIndex(self):
+        for seed in [1399633315, 1, 2]:
+            board1 = grow_board(seed, 100)
+            board2 = grow_board(seed, 100, snap=True)
+            self.assertEqual(anchor_positions(board1), anchor_positions(board2))
+
+    @skipIf(numpy is None, 'numpy is required for batch collisions')
+    def testBatchCollisions(self):
+        for seed in [1399633315, 1, 2]:
+            board1 = grow_board(seed, 100)
+            board2 = grow_board(seed, 100, batch=True)
+            self.assertEqual(anchor_positions(board1), anchor_positions(board2))
+
+    def testGridCellSize(self):
+        # Collisions do not depend on the grid, which is sized to the longest edge
+        board1 = grow_board(1, 200)
+        self.assertEqual(board1.segment_grid.cell_size, 10.0)
+        random.seed(1)
+        edges, shapes = kite_and_dart()
+        board2 = Board(cell_size=2.5)
+        board2.add_anchor(Anchor(50.0, 50.0, 0.0, edges[0]))
+        for i in range(200):
+            add_random_piece(board2, list(shapes))
+        self.assertEqual(anchor_positions(board1), anchor_positions(board2))
+
+    def testExactAngles(self):
+        board1 = grow_board(1399633315, 100, exact=True)
+        board2 = grow_board(1399633315, 100, exact=True, snap=True)
+        self.assertEqual(anchor_positions(board1), anchor_positions(board2))
+        for a in board1.anchors.find_all():
+            self.assertEqual(a.angle, a.step * 36.0)
+            self.assertEqual(a.twin.step, (a.step + 5) % 10)
+
+    def testExactSnapLookups(self):
+        edges, shapes = kite_and_dart()
+        for snap in [False, True]:
+            board = Board(snap=snap, exact=True)
+            board.add_anchor(Anchor(50.0, 50.0, 0.0, edges[0]))
+            self.assertTrue(board.lookup_anchor(50.5, 50.0, 0.0) is not None)
+            # Close angles only match when not exact
+            self.assertEqual(board.lookup_anchor(50.0, 50.0, 5.0), None)
+
+    def testSchedulers(self):
+        for scheduler in [FifoScheduler(), CentreScheduler(), RandomScheduler()]:
+            board = grow_board(1, 50, scheduler=scheduler)
+            self.assertEqual(len(board.pieces) + board.failures, 50)
+            self.assertTrue(board.get_next_anchor().piece is None)
+        
+        scheduler = CentreScheduler(0.0, 0.0)
+        pts = [Anchor(5, 5, 0.0, None), Anchor(1, 1, 0.0, None), Anchor(3, 3, 0.0, None)]
+        for pt in pts:
+            scheduler.push(pt)
+        pts[1].piece = 'filled'
+        self.assertEqual(scheduler.pop(), pts[2])
+        self.assertEqual(scheduler.pop(), pts[0])
+        self.assertEqual(scheduler.pop(), None)
+
+    def testBacktracking(self):
+        board = grow_board(1, 200, exact=True, snap=True, backtrack=4)
+        self.assertEqual(board.stats['pieces'], 200)
+        anchors = board.anchors.find_all()
+        self.assertFalse(any(a.removed for a in anchors))
+        self.assertEqual(set(a for p in board.pieces for a in p.anchors) - set(anchors), set())
+        for p in board.pieces:
+            for a in p.anchors:
+                self.assertTrue(a.piece is p)
+    
+    def testBacktrackingHoles(self):
+        edges, shapes = kite_and_dart()
+        board = Board(exact=True, snap=True)
+        board.add_anchor(Anchor(50.0, 50.0, 0.0, edges[0]))
+        random.seed(3)
+        tiler = BacktrackingTiler(board, shapes, depth=4, max_retries=2, max_retry_keys=8)
+        tiler.grow(400)
+        # Each hole is a failure once, however often its anchor is recreated
+        open_keys = set(tiler.get_retry_key(a) for a in board.anchors.find_all() if a.piece is None)
+        self.assertEqual(board.failures, len(tiler.open_holes))
+        self.assertTrue(tiler.open_holes <= open_keys)
+        self.assertTrue(len(tiler.retries) <= 8)
+    
+    def testBacktrackingFewerHoles(self):
+        for seed in [1, 2]:
+            plain = grow_board(seed, 300, exact=True, snap=True)
+            board = grow_board(seed, 300, exact=True, snap=True, backtrack=6)
+            plain_rate = float(plain.failures) / len(plain.pieces)
+            rate = float(board.failures) / len(board.pieces)
+            self.assertTrue(rate < 0.1 * plain_rate, (seed, rate, plain_rate))
+    
+    def testRemovePiece(self):
+        board = grow_board(1, 50, exact=True, snap=True)
+        piece = board.pieces[10]
+        anchors = list(piece.anchors)
+        reopened = board.remove_piece(piece)
+        self.assertFalse(piece in board.pieces)
+        self.assertEqual(piece.anchors, [])
+        for a in anchors:
+            if a in reopened:
+                self.assertTrue(a.piece is None and not a.removed and a.twin.piece is not None)
+            else:
+                self.assertTrue(a.removed and a.twin.removed)
+        for a in board.anchors.find_all():
+            self.assertTrue(a.piece is not None or a.twin.piece is not None)
+
+    def testMetrics(self):
+        metrics = Metrics()
+        board = grow_board(1, 100, metrics=metrics)
+        counters = metrics.counters
+        self.assertEqual(counters['pieces_placed'], len(board.pieces))
+        self.assertEqual(counters['accepted'], len(board.pieces))
+        self.assertEqual(counters['anchors_created'], len(board.anchors.find_all()))
+        self.assertEqual(counters['dead_ends'], board.failures)
+        rejected = sum(v for k, v in counters.items() if k.startswith('rejected.'))
+        self.assertEqual(counters['plans'], counters['accepted'] + rejected)
+        self.assertTrue(counters['anchor_lookups'] > 0 and metrics.timers['collision_checks'] > 0)
+        self.assertEqual(json.loads(metrics.to_json())['counters']['pieces_placed'], len(board.pieces))
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+    
+    def testGenerateBatch(self):
+        # Enough seeds that the pool hands each worker several at once
+        seeds = range(20)
+        results = generate_batch(seeds, 40, self.output_dir, processes=2, scheduler=RandomScheduler())
+        self.assertEqual([r['seed'] for r in results], seeds)
+        for r in results:
+            self.assertEqual(set(r), set(['seed', 'path', 'pieces', 'failures', 'grow_seconds', 'render_seconds']))
+            self.assertEqual(r['pieces'] + r['failures'], 40)
+            self.assertEqual(r['path'], os.path.join(self.output_dir, 'penrose-%d.svg' % r['seed']))
+            
+            # Each board depends only on its seed, not on the worker that grew it
+            board = grow_board(r['seed'], 40, scheduler=RandomScheduler())
+            self.assertEqual((r['pieces'], r['failures']), (len(board.pieces), board.failures))
+            self.assertEqual(open(r['path']).read(), board_to_svg(board))
+
+    def testBatchMetrics(self):
+        results = generate_batch(range(10), 30, self.output_dir, processes=2, metrics=True)
+        for r in results:
+            # Each board counts only its own pieces
+            self.assertEqual(r['metrics']['counters']['pieces_placed'], r['pieces'])
+            self.assertEqual(r['metrics']['counters']['dead_ends'], r['failures'])
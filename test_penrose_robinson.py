@@ -0,0 +1,240 @@
+import os
+import re
+import imp
+import random
+import shutil
+import tempfile
+import multiprocessing
+from StringIO import StringIO
+from unittest import TestCase
+from xml.dom import minidom
+
+penrose_robinson = imp.load_source('penrose_robinson', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'penrose-robinson.py'))
+
+from penrose_robinson import Board, P2Tiling, FrameWriter
+
+
+def make_board(x1=-410.0, y1=-410.0, x2=410.0, y2=410.0, tiling=None):
+    random.seed(1)
+    board = Board(x1, y1, x2, y2, keep_generations=0)
+    if tiling is None:
+        tiling = P2Tiling()
+    tiling.create_circle(board, 0.0, 0.0, -90.0, 400.0)
+    return board
+
+
+def positions(triangles):
+    return sorted((t.archetype.name, round(t.x, 6), round(t.y, 6), round(t.angle, 6), round(t.scale, 6)) for t in triangles)
+
+
+class DeflationTests(TestCase):
+    def testDepthFirstGeneration(self):
+        board = make_board()
+        expected = positions(board.iter_generation(4))
+        for i in range(4):
+            board.deflate()
+        self.assertEqual(positions(board.triangles), expected)
+
+    def testDepthFirstClipping(self):
+        board = make_board(0.0, 0.0, 200.0, 200.0)
+        triangles = list(board.iter_generation(3))
+        self.assertTrue(len(triangles) > 0)
+        for t in triangles:
+            self.assertTrue(t.within(0.0, 0.0, 200.0, 200.0))
+
+    def testKeepGenerations(self):
+        for keep_generations in [None, 0, 2]:
+            board = make_board()
+            board.keep_generations = keep_generations
+            generations = []
+            for i in range(4):
+                generations.append(board.triangles)
+                board.deflate()
+            kept = [triangles for triangles, transform in board.old_generations]
+            if keep_generations is None:
+                self.assertEqual(kept, generations)
+            else:
+                self.assertEqual(kept, generations[len(generations) - keep_generations:])
+
+
+class CullingTests(TestCase):
+    def testWithin(self):
+        board = make_board()
+        t = max(board.triangles, key=lambda t: t.scale)
+        xs = [px for px, py in t.get_points()]
+        ys = [py for px, py in t.get_points()]
+        # A tiny rectangle around the centroid has no vertex inside it
+        cx = sum(xs) / len(xs)
+        cy = sum(ys) / len(ys)
+        self.assertTrue(t.within(cx - 0.01, cy - 0.01, cx + 0.01, cy + 0.01))
+        # A rectangle beyond the triangle, in y only
+        self.assertFalse(t.within(min(xs), max(ys) + 1.0, max(xs), max(ys) + 1000.0))
+        self.assertTrue(t.within(min(xs) - 1.0, min(ys) - 1.0, max(xs) + 1.0, max(ys) + 1.0))
+
+    def testWithinMatchesOutline(self):
+        board = make_board()
+        board.deflate()
+        for t in board.triangles:
+            points = t.get_points()
+            for px, py in points:
+                self.assertTrue(t.within(px - 0.5, py - 0.5, px + 0.5, py + 0.5))
+
+
+class BatchTests(TestCase):
+    def testBatchMatchesObjects(self):
+        board = make_board()
+        g = board.get_batch_generation(5)
+        for i in range(5):
+            board.deflate()
+        self.assertEqual(len(g), len(board.triangles))
+        self.assertEqual(positions(g.iter_triangles()), positions(board.triangles))
+
+    def testBatchClipping(self):
+        board = make_board(0.0, 0.0, 200.0, 200.0)
+        expected = positions(board.iter_generation(4))
+        self.assertEqual(positions(board.get_batch_generation(4).iter_triangles()), expected)
+
+    def testBatchEmptyBoard(self):
+        # The circle lies wholly outside the board
+        board = make_board(1000.0, 1000.0, 1100.0, 1100.0)
+        self.assertEqual(len(board.triangles), 0)
+        g = board.get_batch_generation(3)
+        self.assertEqual(len(g), 0)
+        self.assertEqual(list(g.iter_triangles()), [])
+        self.assertEqual(len(g.lonely()), 0)
+
+    def check_neighbours(self, *bounds):
+        tiling = P2Tiling()
+        board = make_board(*bounds, tiling=tiling)
+        g = board.get_batch_generation(4, tiling.get_tables())
+        for i in range(4):
+            board.deflate()
+        
+        triangles = list(g.iter_triangles())
+        # Compare neighbours by position, rounded as in positions
+        key = lambda t: positions([t])[0]
+        expected = set()
+        for t in board.triangles:
+            for side, n in enumerate(t.neighbours):
+                if n is not None and n[0] in board.triangles:
+                    expected.add((key(t), side, key(n[0]), n[1]))
+        found = set()
+        for i, t in enumerate(triangles):
+            for side in range(3):
+                j = g.neighbours[i, side]
+                if j >= 0:
+                    found.add((key(t), side, key(triangles[j]), g.neighbour_sides[i, side]))
+        self.assertEqual(found, expected)
+        
+        lonely = [key(t) for t, l in zip(triangles, g.lonely()) if l]
+        self.assertEqual(sorted(lonely), positions(t for t in board.triangles if t.is_lonely()))
+        return len(lonely)
+
+    def testBatchNeighbours(self):
+        # The edge of the circle leaves some lonely triangles
+        self.assertTrue(self.check_neighbours() > 0)
+
+    def testBatchNeighboursClipped(self):
+        self.check_neighbours(0.0, 0.0, 200.0, 200.0)
+
+    def testBatchTables(self):
+        tiling = P2Tiling()
+        board = make_board(tiling=tiling)
+        self.assertTrue(board.get_batch_generation(2).tables is tiling.get_tables())
+        board = make_board()
+        self.assertTrue(board.get_batch_generation(1).tables is board.get_batch_generation(2).tables)
+
+    def testBatchColours(self):
+        g = make_board().get_batch_generation(4)
+        # Colour each triangle in turn, and its partners, like set_colour
+        owners = range(len(g))
+        for i in range(len(g)):
+            owners[i] = i
+            for side in range(g.tables.num_sides):
+                j = g.neighbours[i, side]
+                if j >= 0 and not g.tables.happy[g.ids[i], side]:
+                    owners[j] = i
+        self.assertEqual(g.get_colour_owners().tolist(), owners)
+
+    def testWriteBatchGeneration(self):
+        board = make_board()
+        g = board.get_batch_generation(3)
+        f = StringIO()
+        board.write_generation_svg(f, 3, batch=True)
+        svg = f.getvalue()
+        minidom.parseString(svg)
+        self.assertEqual(svg.count('<use '), len(g))
+        self.assertEqual(svg.count('opacity="0.25"'), g.lonely().sum())
+        # Triangles are written in order, each in the colour of its owner
+        colours = re.findall(r'<use [^>]* fill="(#[0-9a-f]{6})"', svg)
+        owners = g.get_colour_owners().tolist()
+        self.assertTrue(any(j != i for i, j in enumerate(owners)))
+        self.assertEqual(colours, [colours[j] for j in owners])
+
+
+class RenderTests(TestCase):
+    def testSymbols(self):
+        board = make_board()
+        board.deflate()
+        svg = board.render_to_svg()
+        # Each archetype is defined once and each triangle uses one
+        for archetype in board.get_archetypes():
+            self.assertEqual(svg.count('id="%s"' % archetype.name), 1)
+        self.assertEqual(svg.count('<use '), len(board.triangles))
+        self.assertEqual(svg.count('<path '), sum(len(a.decors) for a in board.get_archetypes()))
+        minidom.parseString(svg)
+
+    def testOldGenerations(self):
+        board = make_board()
+        board.keep_generations = None
+        # Where the old per-triangle shift put each generation's triangles
+        expected = []
+        for i in range(3):
+            expected.extend(positions(board.triangles))
+            board.deflate()
+            for j in range(len(expected)):
+                name, x, y, angle, scale = expected[j]
+                expected[j] = (name, (x - 75.0) * 0.75, y * 0.75, angle, scale * 0.75)
+        expected.extend(positions(board.triangles))
+        
+        svg = board.render_to_svg(show_old=True)
+        minidom.parseString(svg)
+        use_re = re.compile(r'<use xlink:href="#([\w-]+)" transform="translate\(([-\d.]+), ([-\d.]+)\) rotate\(([-\d.]+)\) scale\(([-\d.]+)\)"')
+        group_re = re.compile(r'<g transform="translate\(([-\d.]+), ([-\d.]+)\) scale\(([-\d.]+)\)">')
+        actual = []
+        dx, dy, s = 0.0, 0.0, 1.0
+        for line in svg.split('\n'):
+            m = group_re.match(line)
+            if m:
+                dx, dy, s = [float(v) for v in m.groups()]
+            elif line.startswith('</g>'):
+                dx, dy, s = 0.0, 0.0, 1.0
+            m = use_re.search(line)
+            if m:
+                name, x, y, angle, scale = m.group(1), float(m.group(2)), float(m.group(3)), float(m.group(4)), float(m.group(5))
+                actual.append((name, dx + s * x, dy + s * y, angle, s * scale))
+        
+        rounded = lambda ps: sorted((name, round(x, 3), round(y, 3), round(angle, 3), round(scale, 3)) for name, x, y, angle, scale in ps)
+        self.assertEqual(rounded(actual), rounded(expected))
+
+    def testFrameWriter(self):
+        board = make_board()
+        board.deflate()
+        expected = board.render_to_svg()
+        
+        path = os.path.join(tempfile.mkdtemp(), 'frame.svg')
+        pool = multiprocessing.Pool(2)
+        frame = FrameWriter(board, pool, path, tiles=3)
+        # The board may change before the frame is finished
+        board.deflate()
+        frame.finish()
+        pool.close()
+        pool.join()
+        
+        f = open(path, 'rt')
+        svg = f.read()
+        f.close()
+        lines = lambda s: sorted(l for l in s.split('\n') if l)
+        self.assertEqual(lines(svg), lines(expected))
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['frame.svg'])
+        shutil.rmtree(os.path.dirname(path))
@@ -0,0 +1,112 @@
+import re
+import sys
+import types
+from StringIO import StringIO
+from unittest import TestCase
+from xml.dom import minidom
+
+import polyhedra
+from polyhedra import compile_shape, check_shape, draw_shape, find_repeats, render_svg, iter_svg, render_faces, Face, ShapeRenderer, orange_data1, cube_data
+
+
+def recording_functions(calls):
+    """Shape functions that record their calls; p returns three points."""
+    def function(name, num):
+        def f(pt, write):
+            calls.append((name, pt))
+            return [pt * 10 + i for i in range(num)]
+        return f
+    return {'p': function('p', 3), 's': function('s', 0), 'e': function('e', 0)}
+
+
+class CompileTests(TestCase):
+    def testTree(self):
+        self.assertEqual(compile_shape('p4(s e p6) p8'), (('p4', (('s', None), ('e', None), ('p6', None))), ('p8', None)))
+
+    def testEmptyBrackets(self):
+        self.assertEqual(compile_shape('p4()'), (('p4', ()),))
+
+    def testCached(self):
+        self.assertTrue(compile_shape(orange_data1) is compile_shape(orange_data1))
+
+    def testErrors(self):
+        for shape_data in ['p4(p4', 'p4)', '(p4)', 'p4 + p6', 'p4(s)(e)']:
+            self.assertRaises(ValueError, compile_shape, shape_data)
+
+    def testCallOrder(self):
+        calls = []
+        ShapeRenderer(recording_functions(calls), [].append).render([1], compile_shape('p(p s)'))
+        # A leaf's first point gets s and the rest e; points left over get e
+        self.assertEqual(calls, [('p', 1), ('p', 10), ('s', 100), ('e', 101), ('e', 102), ('s', 11), ('e', 12)])
+
+    def testCheck(self):
+        check_shape([1], compile_shape('p(p(s e p) s)'), recording_functions([]))
+        for shape_data in ['foo', 'p4 p4', 'p4(p4 p4 p4 p4 p4)', 'p4(p6(p4) p8(s e e e e e e e e))']:
+            parts = []
+            self.assertRaises(ValueError, render_svg, parts.append, shape_data)
+            # Nothing is written for a bad shape
+            self.assertEqual(parts, [])
+        self.assertRaises(ValueError, draw_shape, [1], 'p(p p p p)', recording_functions([]))
+
+    def testDrawToStdout(self):
+        # Without write, draw_shape uses sys.stdout as it is when called
+        def s(pt, write):
+            write('s%d ' % pt)
+            return []
+        functions = {'p': lambda pt, write: [pt], 's': s, 'e': s}
+        saved = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            draw_shape([1], 'p(s)', functions)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = saved
+        self.assertEqual(output, 's1 ')
+
+
+class RenderTests(TestCase):
+    def testRepeats(self):
+        repeats = find_repeats(compile_shape(orange_data1))
+        self.assertEqual(sorted(name for name, children in repeats), ['p4', 'p8'])
+        self.assertEqual(find_repeats(compile_shape(cube_data)), set())
+
+    def testInstances(self):
+        parts = []
+        render_svg(parts.append, orange_data1, instance=False)
+        full = ''.join(parts)
+        parts = iter_svg(orange_data1)
+        self.assertTrue(isinstance(parts, types.GeneratorType))
+        svg = ''.join(parts)
+        minidom.parseString(svg)
+
+        # Each repeated part is drawn once in its definition and every copy
+        # is a use of it
+        self.assertEqual(full.count('<path '), 26)
+        self.assertEqual(svg.count('<path '), 16)
+        self.assertEqual(len(re.findall(r'<g id="(\w+)">', svg)), 2)
+        self.assertEqual(svg.count('<use '), 4)
+        self.assertTrue(len(svg) < len(full))
+
+
+class FaceTests(TestCase):
+    def testBatchMatchesScalar(self):
+        faces = [Face(1.5, -2.0, 0.3 * i, 10.0, num, [0, 0.1, 0.5, 1.0]) for i in range(10) for num in [4, 6, 8]]
+        paths = render_faces(faces)
+        numpy = polyhedra.numpy
+        try:
+            polyhedra.numpy = None
+            self.assertEqual(render_faces(faces), paths)
+        finally:
+            polyhedra.numpy = numpy
+
+    def testPrecision(self):
+        path = render_faces([Face(0.0, 0.0, 0.0, 10.0, 4, [0])], precision=2)[0]
+        self.assertEqual(path, '<path fill-rule="evenodd" d="M 0.00,5.00 10.00,5.00 10.00,-5.00 0.00,-5.00 Z" />\n')
+
+    def testBatches(self):
+        nodes = compile_shape(orange_data1)
+        whole = []
+        ShapeRenderer(polyhedra.FUNCTIONS, whole.append).render([polyhedra.START_POINT], nodes)
+        parts = []
+        ShapeRenderer(polyhedra.FUNCTIONS, parts.append, batch_size=3).render([polyhedra.START_POINT], nodes)
+        self.assertEqual(parts, whole)